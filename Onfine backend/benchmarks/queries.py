@@ -0,0 +1,276 @@
+'''
+Latency and SQLite query plans of the hot read endpoints (/chat/all, /chat/messages, /chat/posts,
+/user/search, /chat/search) on a database made by benchmarks/seed.py. Requests go through the app
+in this process (without network), after warmup, so caches of tokens and members are warm like
+at a working server. Every SQL statement of a request gets EXPLAIN QUERY PLAN.
+
+Results are written to a JSON file, which can be given to --compare by the next run, to see
+changes of latency and plans after changes of schema, indexes or queries.
+
+Run from the backend directory:
+    python benchmarks/seed.py --db bench.db
+    python benchmarks/queries.py --db bench.db --json baseline.json
+    python benchmarks/queries.py --db bench.db --json new.json --compare baseline.json
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, UTC
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TABLES = ('users', 'chats', 'chat_user', 'messages', 'likes')
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def pick_subjects(path: str) -> dict:
+    '''Users, chats and search values which the requests are made for.'''
+
+    conn = sqlite3.connect(path)
+
+    try:
+        def one(sql: str, *params):
+            return conn.execute(sql, params).fetchone()
+
+        members = one('SELECT count(DISTINCT user_id) FROM chat_user')[0]
+        chats_per_user = 'SELECT user_id, count(*) AS chats FROM chat_user GROUP BY user_id ORDER BY chats DESC'
+
+        heavy_user, heavy_chats = one(chats_per_user + ' LIMIT 1')
+        typical_user, typical_chats = one(chats_per_user + ' LIMIT 1 OFFSET ?', members // 2)
+        reader, channels = one('''
+            SELECT chat_user.user_id, count(*) AS channels FROM chat_user
+            JOIN chats ON chats.id = chat_user.chat_id AND chats.type = 'channel'
+            GROUP BY chat_user.user_id ORDER BY channels DESC LIMIT 1
+        ''')
+        chat_id, chat_messages = one('SELECT chat_id, count(*) AS messages FROM messages GROUP BY chat_id ORDER BY messages DESC LIMIT 1')
+        chat_member = one('SELECT user_id FROM chat_user WHERE chat_id = ? LIMIT 1', chat_id)[0]
+        # a page from the middle of the history
+        middle = one('SELECT date_time, id FROM messages WHERE chat_id = ? ORDER BY date_time DESC, id DESC LIMIT 1 OFFSET ?', chat_id, chat_messages // 2)
+        # nickname of other user, users are not found by themselves
+        nickname = one('SELECT nickname FROM users WHERE id = ?', heavy_user)[0]
+        chat_name = one("SELECT name FROM chats WHERE is_private = 0 AND name IS NOT NULL ORDER BY rowid LIMIT 1")
+
+        rows = { table: one(f'SELECT count(*) FROM {table}')[0] for table in TABLES }
+    finally:
+        conn.close()
+
+    return {
+        'heavy_user':    (heavy_user, heavy_chats),
+        'typical_user':  (typical_user, typical_chats),
+        'reader':        (reader, channels),
+        'chat':          (chat_id, chat_messages, chat_member),
+        'middle':        (datetime.fromisoformat(middle[0]), middle[1]),
+        'nickname':      nickname,
+        'chat_name':     chat_name[0] if chat_name else 'group',
+        'rows':          rows,
+    }
+
+
+def explain(engine, statement: str, parameters) -> list[str]:
+    from monitoring.slow_queries import format_plan
+
+    with engine.connect() as conn:
+        return format_plan(conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all())
+
+
+def capture(engine, call) -> list[tuple]:
+    '''SQL statements which are executed by one request.'''
+
+    from sqlalchemy import event
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    return statements
+
+
+def run(args: argparse.Namespace, subjects: dict) -> dict:
+    # the app is imported when its settings are in environment and its directories exist
+    from fastapi.testclient import TestClient
+    import main
+    from database.database import engine
+    from security.tokens import auth_user
+    from tools import encode_cursor
+
+    heavy_user = subjects['heavy_user'][0]
+    typical_user = subjects['typical_user'][0]
+    reader = subjects['reader'][0]
+    chat_id, _, chat_member = subjects['chat']
+    nickname = subjects['nickname']
+    chat_name = subjects['chat_name']
+    tokens = {}
+
+    def auth(user_id: str) -> dict:
+        if not user_id in tokens:
+            tokens[user_id] = auth_user(user_id)
+
+        return { 'user_id': user_id, 'token': tokens[user_id] }
+
+    page = { 'limit': args.limit, 'inline_images': False }
+    cases = [
+        ('chat_all_heavy',      'POST', '/chat/all',      lambda: { 'json': auth(heavy_user) }),
+        ('chat_all_typical',    'POST', '/chat/all',      lambda: { 'json': auth(typical_user) }),
+        ('chat_messages_first', 'POST', '/chat/messages', lambda: { 'json': { **auth(chat_member), **page, 'chat_id': chat_id } }),
+        ('chat_messages_deep',  'POST', '/chat/messages', lambda: { 'json': { **auth(chat_member), **page, 'chat_id': chat_id, 'cursor': encode_cursor(*subjects['middle']) } }),
+        ('chat_posts',          'POST', '/chat/posts',    lambda: { 'json': { **auth(reader), **page } }),
+        ('user_search_prefix',  'POST', '/user/search',   lambda: { 'json': { **auth(typical_user), 'value': nickname[:2] } }),
+        ('user_search_fts',     'POST', '/user/search',   lambda: { 'json': { **auth(typical_user), 'value': nickname.split('_')[0][1:] } }),
+        ('user_search_exact',   'POST', '/user/search',   lambda: { 'json': { **auth(typical_user), 'value': nickname } }),
+        ('chat_search_prefix',  'GET',  '/chat/search',   lambda: { 'params': { 'value': chat_name[:2] } }),
+        ('chat_search_fts',     'GET',  '/chat/search',   lambda: { 'params': { 'value': chat_name.split()[0][1:] } }),
+    ]
+    results = {}
+
+    with TestClient(main.app) as client:
+        for name, method, path, request in cases:
+            if args.cases and not name in args.cases:
+                continue
+
+            def call():
+                response = client.request(method, path, **request())
+
+                if response.status_code != 200:
+                    raise RuntimeError(f'{name}: {response.status_code} {response.text[:200]}')
+
+                return response
+
+            for _ in range(args.warmup):
+                call()
+
+            statements = capture(engine, call)
+            times = []
+
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                response = call()
+                times.append((time.perf_counter() - start) * 1000)
+
+            results[name] = {
+                'method':  method,
+                'path':    path,
+                'items':   len(response.json()),
+                'p50_ms':  round(percentile(times, 0.5), 3),
+                'p95_ms':  round(percentile(times, 0.95), 3),
+                'p99_ms':  round(percentile(times, 0.99), 3),
+                'mean_ms': round(sum(times) / len(times), 3),
+                'queries': [
+                    { 'sql': statement, 'plan': explain(engine, statement, parameters) }
+                    for statement, parameters in statements
+                    if statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+                ],
+            }
+
+            result = results[name]
+            print(f'{name:20} {path:15} p50 {result["p50_ms"]:8.2f} ms | p95 {result["p95_ms"]:8.2f} ms | p99 {result["p99_ms"]:8.2f} ms | items {result["items"]:3} | queries {len(result["queries"])}')
+
+            if args.plans:
+                for query in result['queries']:
+                    for line in query['plan']:
+                        print(' ' * 4 + line)
+
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    print(f'\ncompared with {baseline["created"]}, p50 ms:')
+
+    for name, result in results.items():
+        old = baseline['cases'].get(name)
+
+        if old is None:
+            continue
+
+        plans_changed = [query['plan'] for query in result['queries']] != [query['plan'] for query in old['queries']]
+        print(f'{name:20} {old["p50_ms"]:8.2f} -> {result["p50_ms"]:8.2f} ({result["p50_ms"] / old["p50_ms"]:.2f}x)' + (' plan changed' if plans_changed else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and query plans of read endpoints')
+    parser.add_argument('--db', default='bench.db', help='database made by benchmarks/seed.py')
+    parser.add_argument('--repeat', type=int, default=200, help='measured requests per case')
+    parser.add_argument('--warmup', type=int, default=20, help='requests per case before measuring')
+    parser.add_argument('--limit', type=int, default=50, help='page size of messages and posts')
+    parser.add_argument('--cases', nargs='*', help='names of cases to run (all by default)')
+    parser.add_argument('--plans', action='store_true', help='print query plans')
+    parser.add_argument('--json', default='query_baseline.json', help='file to write results to')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db)
+
+    if not os.path.exists(path):
+        parser.error(f'{path} not exists, create it by benchmarks/seed.py')
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    output = os.path.abspath(args.json)
+    subjects = pick_subjects(path)
+
+    os.environ['ONFINE_DB_URL'] = 'sqlite:///' + path
+    os.environ['ONFINE_BROKER'] = 'local'
+    # maintenance (PRAGMA optimize) would run during measurement
+    os.environ['ONFINE_DB_MAINTENANCE_INTERVAL'] = '0'
+    os.environ['ONFINE_SLOW_QUERY_MS'] = '0'
+
+    # main.py mounts these directories
+    workdir = tempfile.mkdtemp(prefix='onfine-queries-')
+    os.makedirs(os.path.join(workdir, 'view'))
+    os.makedirs(os.path.join(workdir, 'images'))
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+
+    try:
+        results = run(args, subjects)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as file:
+        json.dump({
+            'created':        datetime.now(UTC).isoformat(timespec='seconds'),
+            'sqlite_version': sqlite3.sqlite_version,
+            'database': {
+                'file':    os.path.basename(path),
+                'size_mb': round(os.path.getsize(path) / 1024 / 1024, 1),
+                'rows':    subjects['rows'],
+            },
+            'subjects': {
+                'heavy_user_chats':   subjects['heavy_user'][1],
+                'typical_user_chats': subjects['typical_user'][1],
+                'reader_channels':    subjects['reader'][1],
+                'chat_messages':      subjects['chat'][1],
+            },
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'limit':  args.limit,
+            'cases':  results,
+        }, file, indent=2)
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+CPU cost of serializing a page of /chat/all and /chat/messages: pydantic objects validated and
+serialized by response_model (as FastAPI does it) against dicts written by tools.fast_response.
+
+Run from the backend directory: python benchmarks/responses.py [--items 100] [--repeat 2000]
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+import models.responses as resp
+import tools
+
+
+def chat_rows(count: int) -> list[tuple]:
+    now = datetime(2026, 1, 1)
+
+    return [(
+        f'{i:032x}', 'group', f'Chat {i}', 'Description of the chat', i % 2 == 0, True, 12,
+        now, 'x' * 80, now + timedelta(seconds=i), f'{i + 1:032x}', False, 'k' * 64, i % 5, None
+    ) for i in range(count)]
+
+def message_rows(count: int) -> list[tuple]:
+    now = datetime(2026, 1, 1)
+
+    return [(
+        f'{i:032x}', f'{i % 3:032x}', 'y' * 200, False, now - timedelta(seconds=i), None, None, i % 4, None
+    ) for i in range(count)]
+
+
+def chats_pydantic(rows: list[tuple]) -> list:
+    chats = []
+
+    for row in rows:
+        id_, type_, name, description, with_icon, is_private, members_count, last_reading, msg_content, msg_datetime, msg_sender_id, is_admin, key, unread_count, companion_id = row
+
+        chats.append(resp.Chat(
+            id=id_, type=type_, companion_id=companion_id, name=name, description=description,
+            with_icon=with_icon, is_private=is_private, members_count=members_count,
+            last_reading=last_reading, message_content=msg_content, message_datetime=msg_datetime,
+            message_sender_id=msg_sender_id, is_admin=is_admin, key=key, unread_count=unread_count
+        ))
+
+    return chats
+
+def chats_fast(rows: list[tuple]) -> list:
+    chats = []
+
+    for row in rows:
+        id_, type_, name, description, with_icon, is_private, members_count, last_reading, msg_content, msg_datetime, msg_sender_id, is_admin, key, unread_count, companion_id = row
+
+        chats.append({
+            'id': id_, 'type': type_, 'name': name, 'description': description, 'with_icon': with_icon,
+            'members_count': members_count, 'key': key, 'companion_id': companion_id, 'is_private': is_private,
+            'last_reading': last_reading, 'message_content': msg_content, 'message_datetime': msg_datetime,
+            'message_sender_id': msg_sender_id, 'is_admin': is_admin, 'unread_count': unread_count,
+            'writing_users': [], 'all_messages_is_loaded': False,
+        })
+
+    return chats
+
+def messages_pydantic(rows: list[tuple]) -> list:
+    messages = []
+
+    for row in rows:
+        id_, sender_id, content, with_image, date_time, reply_content, reply_sender_id, likes, is_liked = row
+
+        messages.append(resp.Message(
+            id=id_, sender_id=sender_id, content=content, image=None, image_url=None, date_time=date_time,
+            reply_content=reply_content, reply_sender_id=reply_sender_id, likes=likes, is_liked=not is_liked is None
+        ))
+
+    return messages
+
+def messages_fast(rows: list[tuple]) -> list:
+    messages = []
+
+    for row in rows:
+        id_, sender_id, content, with_image, date_time, reply_content, reply_sender_id, likes, is_liked = row
+
+        messages.append({
+            'id': id_, 'sender_id': sender_id, 'content': content, 'image': None, 'image_url': None,
+            'date_time': date_time, 'likes': likes, 'is_liked': not is_liked is None,
+            'reply_content': reply_content, 'reply_sender_id': reply_sender_id,
+        })
+
+    return messages
+
+
+async def response_model_path(build, rows, field) -> bytes:
+    # the same steps as FastAPI makes for a route which returns objects
+    content = await serialize_response(field=field, response_content=build(rows), is_coroutine=False)
+    return JSONResponse(content).body
+
+async def fast_path(build, rows, field) -> bytes:
+    return tools.fast_response(build(rows)).body
+
+
+def measure(path, build, rows, field, repeat: int) -> float:
+    async def run():
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            await path(build, rows, field)
+
+        return time.perf_counter() - start
+
+    return asyncio.run(run()) / repeat * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = [
+        ('/chat/all',      list[resp.Chat],    chat_rows(args.items),    chats_pydantic,    chats_fast),
+        ('/chat/messages', list[resp.Message], message_rows(args.items), messages_pydantic, messages_fast),
+    ]
+    orjson = tools.orjson
+
+    print(f'{args.items} items per page, {args.repeat} requests, us per request')
+
+    for route, model, rows, build_pydantic, build_fast in cases:
+        field = create_response_field(name=f'Response {route}', type_=model)
+
+        # both paths must give the same JSON
+        assert asyncio.run(response_model_path(build_pydantic, rows, field)) == asyncio.run(fast_path(build_fast, rows, field))
+
+        base = measure(response_model_path, build_pydantic, rows, field, args.repeat)
+        fast = measure(fast_path, build_fast, rows, field, args.repeat) if orjson else None
+
+        tools.orjson = None
+        fast_json = measure(fast_path, build_fast, rows, field, args.repeat)
+        tools.orjson = orjson
+
+        print(f'{route:16} response_model {base:8.1f}', end='')
+
+        if fast is not None:
+            print(f' | fast (orjson) {fast:8.1f} ({base / fast:.1f}x)', end='')
+
+        print(f' | fast (json) {fast_json:8.1f} ({base / fast_json:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+'''
+Synthetic data for query benchmarks: creates a database by migrations and bulk-loads users,
+direct chats, groups, channels, their members, messages and likes. Sizes of chats and their
+activity are skewed (a few chats have most of the messages), like in a real messenger.
+
+Run from the backend directory:
+    python benchmarks/seed.py --db bench.db --users 10000 --messages 1000000
+    python benchmarks/seed.py --db bench.db --users 200000 --groups 20000 --channels 2000 --messages 10000000
+
+Data is the same for the same arguments and --seed.
+'''
+
+import argparse
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bcrypt
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# all dates are before this one, so benchmarks don't depend on the day they are run
+END_DATETIME = datetime(2026, 1, 1)
+
+NAMES = [
+    'anna', 'olena', 'iryna', 'maria', 'sofia', 'kateryna', 'oksana', 'natalia', 'yulia', 'daryna',
+    'taras', 'andrii', 'dmytro', 'oleksandr', 'mykola', 'bohdan', 'ivan', 'serhii', 'maksym', 'yurii',
+]
+WORDS = [
+    'music', 'travel', 'football', 'python', 'design', 'crypto', 'books', 'cinema', 'kyiv', 'lviv',
+    'news', 'memes', 'games', 'science', 'startup', 'photo', 'running', 'coffee', 'anime', 'jobs',
+]
+TEXT = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore'.split()
+
+
+def timestamp(value: datetime) -> str:
+    # the same format as SQLAlchemy writes TIMESTAMP to SQLite, so keyset comparisons work
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def uuid_hex(rand: random.Random) -> str:
+    return '%032x' % rand.getrandbits(128)
+
+def text(rand: random.Random, words: int) -> str:
+    return ' '.join(rand.choices(TEXT, k=words))
+
+
+class Seeder:
+    def __init__(self, args: argparse.Namespace, conn: sqlite3.Connection):
+        self.args = args
+        self.conn = conn
+        self.rand = random.Random(args.seed)
+        self.start = END_DATETIME - timedelta(days=args.days)
+
+        self.user_ids: list[str] = []
+        # chat id -> member ids, the first one is the owner (admin)
+        self.members: dict[str, list[str]] = {}
+        self.types: dict[str, str] = {}
+        self.counts: dict[str, int] = {}
+
+    def insert(self, table: str, columns: tuple[str, ...], rows: list[tuple]):
+        if rows:
+            placeholders = ', '.join('?' * len(columns))
+            self.conn.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})', rows)
+            self.counts[table] = self.counts.get(table, 0) + len(rows)
+
+    def users(self):
+        # every user has this password, hashing is slow so it's done once
+        password = bcrypt.hashpw(b'password', bcrypt.gensalt(4)).decode()
+        rows = []
+
+        for i in range(self.args.users):
+            id_ = uuid_hex(self.rand)
+            name = self.rand.choice(NAMES)
+            last_visit = timestamp(END_DATETIME - timedelta(seconds=self.rand.randrange(self.args.days * 86400)))
+
+            self.user_ids.append(id_)
+            rows.append((
+                id_, f'user{i}@example.com', password, name.capitalize(), f'{name}_{i}', 0,
+                last_visit, 'pub_key', 'priv_key', timestamp(self.start), 0
+            ))
+
+        self.insert('users', (
+            'id', 'email', 'password', 'name', 'nickname', 'with_avatar',
+            'last_visit', 'pub_key', 'priv_key', 'latest_key_update', 'profile_version'
+        ), rows)
+
+    def chat(self, type_: str, members: list[str], name: str | None, is_private: bool) -> tuple:
+        id_ = uuid_hex(self.rand)
+        self.members[id_] = members
+        self.types[id_] = type_
+
+        return (id_, type_, name, 'Description of the chat' if name else None, 0, is_private, len(members), timestamp(self.start))
+
+    def chats(self):
+        args = self.args
+        rows = []
+        pairs = set()
+
+        # direct chats, args.direct per user on average
+        for _ in range(args.users * args.direct // 2):
+            pair = tuple(sorted(self.rand.sample(self.user_ids, 2)))
+
+            if not pair in pairs:
+                pairs.add(pair)
+                rows.append(self.chat('chat', list(pair), None, True))
+
+        for i in range(args.groups):
+            size = min(args.users, max(3, int(self.rand.paretovariate(1.2) * 3)), args.group_size)
+            members = self.rand.sample(self.user_ids, size)
+            rows.append(self.chat('group', members, f'{self.rand.choice(WORDS)} group {i}', self.rand.random() < 0.5))
+
+        for i in range(args.channels):
+            size = min(args.users, max(10, int(self.rand.paretovariate(1.1) * 10)), args.channel_size)
+            members = self.rand.sample(self.user_ids, size)
+            rows.append(self.chat('channel', members, f'{self.rand.choice(WORDS)} channel {i}', self.rand.random() < 0.2))
+
+        self.insert('chats', ('id', 'type', 'name', 'description', 'with_icon', 'is_private', 'members_count', 'last_reading'), rows)
+
+        rows = []
+
+        for chat_id, members in self.members.items():
+            is_direct = self.types[chat_id] == 'chat'
+
+            for i, user_id in enumerate(members):
+                rows.append((user_id, chat_id, is_direct or i == 0, 'chat_key' if is_direct else None, 0))
+
+            if len(rows) >= args.batch:
+                self.insert('chat_user', ('user_id', 'chat_id', 'is_admin', 'key', 'unread_count'), rows)
+                rows = []
+
+        self.insert('chat_user', ('user_id', 'chat_id', 'is_admin', 'key', 'unread_count'), rows)
+
+    def messages(self):
+        args = self.args
+        chat_ids = list(self.members)
+        # activity of chats has Zipf distribution
+        self.rand.shuffle(chat_ids)
+        cum_weights = []
+        total = 0
+
+        for rank in range(len(chat_ids)):
+            total += 1 / (rank + 1) ** args.skew
+            cum_weights.append(total)
+
+        # chat id -> (id, content, date_time, sender id) of the latest message
+        last_messages: dict[str, tuple] = {}
+        step = args.days * 86400 / max(args.messages, 1)
+        message_columns = ('id', 'chat_id', 'sender_id', 'content', 'with_image', 'date_time', 'reply_content', 'reply_sender_id', 'likes_count')
+        started = time.monotonic()
+
+        for batch_start in range(0, args.messages, args.batch):
+            count = min(args.batch, args.messages - batch_start)
+            messages = []
+            likes = []
+
+            for i, chat_id in enumerate(self.rand.choices(chat_ids, cum_weights=cum_weights, k=count), batch_start):
+                members = self.members[chat_id]
+                id_ = uuid_hex(self.rand)
+                # only the owner writes to a channel
+                sender_id = members[0] if self.types[chat_id] == 'channel' else self.rand.choice(members)
+                content = text(self.rand, self.rand.randint(1, 20))
+                date_time = timestamp(self.start + timedelta(seconds=i * step))
+                reply_content, reply_sender_id = None, None
+
+                if self.rand.random() < args.reply_ratio:
+                    reply_content, reply_sender_id = text(self.rand, 5), self.rand.choice(members)
+
+                likes_count = 0
+
+                if self.rand.random() < args.like_ratio:
+                    likers = self.rand.sample(members, min(len(members), self.rand.randint(1, args.max_likes)))
+                    likes_count = len(likers)
+                    likes += [(user_id, id_) for user_id in likers]
+
+                messages.append((id_, chat_id, sender_id, content, False, date_time, reply_content, reply_sender_id, likes_count))
+                last_messages[chat_id] = (id_, content, date_time, sender_id)
+
+            self.insert('messages', message_columns, messages)
+            self.insert('likes', ('user_id', 'message_id'), likes)
+
+            done = batch_start + count
+            print(f'\rmessages {done}/{args.messages} ({done / (time.monotonic() - started):.0f}/s)', end='', file=sys.stderr)
+
+        print(file=sys.stderr)
+
+        # copy of the latest message, like message routes keep it
+        self.conn.executemany('''
+            UPDATE chats SET last_message_id = ?, last_message_content = ?, last_message_datetime = ?, last_message_sender_id = ?
+            WHERE id = ?
+        ''', [(*message, chat_id) for chat_id, message in last_messages.items()])
+
+    def indexes(self, tables: tuple[str, ...]) -> list[str]:
+        placeholders = ', '.join('?' * len(tables))
+        query = f"SELECT sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})"
+        return [sql for sql, in self.conn.execute(query, tables)]
+
+    def run(self):
+        # secondary indexes of big tables are built once after the load, it's faster than keeping them updated
+        indexes = self.indexes(('messages', 'likes'))
+
+        for sql in indexes:
+            self.conn.execute('DROP INDEX ' + sql.split()[2])
+
+        for step in (self.users, self.chats, self.messages):
+            started = time.monotonic()
+            step()
+            self.conn.commit()
+            print(f'{step.__name__:10} {time.monotonic() - started:8.1f} s', file=sys.stderr)
+
+        started = time.monotonic()
+
+        for sql in indexes:
+            self.conn.execute(sql)
+
+        self.conn.commit()
+        print(f'{"indexes":10} {time.monotonic() - started:8.1f} s', file=sys.stderr)
+
+        # statistics for the query planner, the server refreshes them by PRAGMA optimize
+        self.conn.execute('ANALYZE')
+        self.conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a database for query benchmarks')
+    parser.add_argument('--db', default='bench.db', help='file of the database')
+    parser.add_argument('--force', action='store_true', help='replace the file if it exists')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--direct', type=int, default=10, help='direct chats per user on average')
+    parser.add_argument('--groups', type=int, default=1_000)
+    parser.add_argument('--group-size', type=int, default=200, help='max members of a group')
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--channel-size', type=int, default=5_000, help='max subscribers of a channel')
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=365, help='messages are spread over this period')
+    parser.add_argument('--skew', type=float, default=0.8, help='exponent of Zipf distribution of messages over chats')
+    parser.add_argument('--like-ratio', type=float, default=0.2, help='share of messages with likes')
+    parser.add_argument('--max-likes', type=int, default=5, help='max likes of a message')
+    parser.add_argument('--reply-ratio', type=float, default=0.1, help='share of messages which are replies')
+    parser.add_argument('--batch', type=int, default=50_000, help='rows per INSERT batch')
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error('at least 2 users are needed')
+
+    path = os.path.abspath(args.db)
+
+    if os.path.exists(path):
+        if not args.force:
+            parser.error(f'{path} exists, use --force to replace it')
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    env = { **os.environ, 'ONFINE_DB_URL': 'sqlite:///' + path }
+    subprocess.run([sys.executable, '-m', 'alembic', 'upgrade', 'head'], cwd=BACKEND_DIR, env=env, check=True, capture_output=True)
+
+    conn = sqlite3.connect(path)
+    # the file is scratch data, so durability is not needed while it's loaded
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-262144')
+
+    seeder = Seeder(args, conn)
+
+    try:
+        seeder.run()
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+    for table, count in seeder.counts.items():
+        print(f'{table:12} {count}')
+
+    print(f'{"size":12} {os.path.getsize(path) / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+'''
+WebSocket load test: starts main:app by uvicorn against a scratch SQLite database, registers users,
+puts them into group chats, opens a /ws connection per user and drives /message/send, /message/like
+and /chat/writing at a fixed rate. Reports send-to-delivery latency (p50, p99, p999), delivered
+events per second and memory of the server per connection.
+
+Run from the backend directory:
+    python benchmarks/ws_load.py --users 200 --group-size 10 --rate 200 --duration 20
+
+Clients run in this process, so on a host with few cores they compete with the server for CPU.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def rss(pid: int) -> int:
+    # resident memory of the server process in bytes (Linux)
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        weights[name.strip()] = float(weight)
+
+    if not set(weights) <= { 'send', 'like', 'writing' }:
+        raise ValueError(f'Unknown operations in mix: {mix}')
+
+    return weights
+
+
+class Server:
+    '''uvicorn with main:app in a subprocess, all its files are in a scratch directory.'''
+
+    def __init__(self, workdir: str, port: int, env: dict[str, str]):
+        self.workdir = workdir
+        self.port = port
+        self.env = env
+        self.process: subprocess.Popen | None = None
+
+    def start(self):
+        # main.py mounts these directories
+        os.makedirs(os.path.join(self.workdir, 'view'), exist_ok=True)
+        os.makedirs(os.path.join(self.workdir, 'images'), exist_ok=True)
+
+        subprocess.run([sys.executable, '-m', 'alembic', 'upgrade', 'head'], cwd=BACKEND_DIR, env=self.env, check=True, capture_output=True)
+
+        self.process = subprocess.Popen([
+            sys.executable, '-m', 'uvicorn', 'main:app',
+            '--app-dir', BACKEND_DIR,
+            '--host', '127.0.0.1',
+            '--port', str(self.port),
+            '--log-level', 'warning',
+        ], cwd=self.workdir, env=self.env)
+
+        for _ in range(200):
+            try:
+                httpx.get(f'http://127.0.0.1:{self.port}/ws/stats', timeout=1)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.05)
+
+        raise RuntimeError('Server has not started')
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(10)
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, port: int):
+        self.args = args
+        self.base_url = f'http://127.0.0.1:{port}'
+        self.ws_url = f'ws://127.0.0.1:{port}/ws'
+        self.mix = parse_mix(args.mix)
+
+        self.users: list[dict] = []
+        # user id -> chat id of user's group
+        self.chat_of: dict[str, str] = {}
+        # message ids of every chat, they are liked
+        self.messages: dict[str, list[str]] = {}
+
+        # key of event -> time when its request was sent
+        self.sent_at: dict[tuple, float] = {}
+        self.latencies: list[float] = []
+        self.request_latencies: list[float] = []
+        self.errors = 0
+        self.delivered = 0
+        self.measuring = False
+
+    async def setup(self, client: httpx.AsyncClient):
+        limit = asyncio.Semaphore(16)
+
+        async def register(i: int):
+            async with limit:
+                r = await client.post('/user/register', json={
+                    'email': f'load{i}@example.com',
+                    'password': 'password',
+                    'name': f'User {i}',
+                    'nickname': f'load_user_{i}',
+                    'pub_key': 'pub',
+                    'priv_key': 'priv',
+                })
+                r.raise_for_status()
+                return r.json()
+
+        self.users = list(await asyncio.gather(*(register(i) for i in range(self.args.users))))
+
+        for i in range(0, len(self.users), self.args.group_size):
+            group = self.users[i:i + self.args.group_size]
+
+            if len(group) < 2:
+                break
+
+            owner = group[0]
+            data = {
+                'user_id': owner['user_id'],
+                'token':   owner['token'],
+                'type':    'group',
+                'name':    f'Group {i}',
+                'members': [{ 'id': user['user_id'], 'is_admin': False } for user in group[1:]],
+            }
+            r = await client.post('/chat/create', data={ 'data': json.dumps(data) })
+            r.raise_for_status()
+            chat_id = r.json()['chat_id']
+            self.messages[chat_id] = []
+
+            for user in group:
+                self.chat_of[user['user_id']] = chat_id
+
+        self.users = [user for user in self.users if user['user_id'] in self.chat_of]
+
+    def decode(self, frame: str | bytes) -> dict:
+        return msgpack.unpackb(frame) if isinstance(frame, bytes) else json.loads(frame)
+
+    def on_event(self, event: dict, now: float):
+        notifi_type = event.get('notifi_type')
+
+        if notifi_type == 'new_message':
+            key = ('send', event['message']['content'])
+        elif notifi_type == 'new_like':
+            key = ('like', event['message_id'], event['is_liked'])
+        elif notifi_type == 'new_writing':
+            key = ('writing', event['user_id'], event['chat_id'], event['is_writing'])
+        else:
+            return
+
+        sent_at = self.sent_at.get(key)
+
+        if sent_at is not None and self.measuring:
+            self.latencies.append(now - sent_at)
+            self.delivered += 1
+
+    async def listen(self, user: dict, ready: asyncio.Event, counter: list[int], opened: asyncio.Event):
+        compression = 'deflate' if self.args.deflate else None
+
+        async with websockets.connect(self.ws_url, compression=compression, max_size=None) as ws:
+            await ws.send(json.dumps({ 'user_id': user['user_id'], 'token': user['token'], 'encoding': self.args.encoding }))
+
+            counter[0] += 1
+
+            if counter[0] == len(self.users):
+                opened.set()
+
+            await ready.wait()
+
+            async for frame in ws:
+                self.on_event(self.decode(frame), time.perf_counter())
+
+    async def operation(self, client: httpx.AsyncClient, name: str):
+        user = random.choice(self.users)
+        chat_id = self.chat_of[user['user_id']]
+        auth = { 'user_id': user['user_id'], 'token': user['token'] }
+
+        if name == 'like' and not self.messages[chat_id]:
+            name = 'send'
+
+        if name == 'send':
+            content = f'{time.perf_counter_ns()}-{random.getrandbits(32)}'
+            message = { 'chat_id': chat_id, 'content': content }
+
+            if self.args.image_size:
+                message['image'] = 'A' * self.args.image_size
+
+            key = ('send', content)
+            path, data = '/message/send', { **auth, 'messages': [message] }
+        elif name == 'like':
+            message_id = random.choice(self.messages[chat_id])
+            # like is switched, so the expected state is unknown, both are waited
+            key = None
+            path, data = '/message/like', { **auth, 'message_id': message_id }
+        else:
+            is_writing = random.random() < 0.5
+            key = ('writing', user['user_id'], chat_id, is_writing)
+            path, data = '/chat/writing', { **auth, 'chat_id': chat_id, 'is_writing': is_writing }
+
+        start = time.perf_counter()
+
+        if key is None:
+            self.sent_at[('like', message_id, True)] = start
+            self.sent_at[('like', message_id, False)] = start
+        else:
+            self.sent_at[key] = start
+
+        try:
+            r = await client.post(path, json=data)
+        except httpx.HTTPError:
+            self.errors += 1
+            return
+
+        self.request_latencies.append(time.perf_counter() - start)
+
+        if r.status_code != 200:
+            self.errors += 1
+            print(path, r.status_code, r.text[:200], file=sys.stderr)
+        elif name == 'send':
+            self.messages[chat_id].append(r.json()['message_ids'][chat_id])
+
+    async def drive(self, client: httpx.AsyncClient):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        interval = 1 / self.args.rate
+        tasks = set()
+        start = time.perf_counter()
+        i = 0
+
+        # open loop: requests are started by the schedule, not after previous responses
+        while time.perf_counter() - start < self.args.duration:
+            next_at = start + i * interval
+            delay = next_at - time.perf_counter()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            task = asyncio.create_task(self.operation(client, random.choices(names, weights)[0]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            i += 1
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        return i
+
+    async def run(self, server: Server) -> dict:
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=60) as client:
+            await self.setup(client)
+
+            memory_before = rss(server.process.pid)
+            ready, opened = asyncio.Event(), asyncio.Event()
+            counter = [0]
+            listeners = [asyncio.create_task(self.listen(user, ready, counter, opened)) for user in self.users]
+
+            await asyncio.wait_for(opened.wait(), 120)
+            # online statuses are sent by presence service in a batch
+            await asyncio.sleep(2)
+            memory_after = rss(server.process.pid)
+
+            ready.set()
+            self.measuring = True
+            start = time.perf_counter()
+            operations = await self.drive(client)
+            # events which are still in queues
+            await asyncio.sleep(self.args.drain)
+            elapsed = time.perf_counter() - start
+            self.measuring = False
+
+            stats = (await client.get('/ws/stats')).json()
+
+            for listener in listeners:
+                listener.cancel()
+
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+        connections = len(self.users)
+
+        return {
+            'users':                    connections,
+            'group_size':               self.args.group_size,
+            'rate':                     self.args.rate,
+            'duration':                 self.args.duration,
+            'mix':                      self.mix,
+            'encoding':                 self.args.encoding,
+            'deflate':                  self.args.deflate,
+            'image_size':               self.args.image_size,
+            'operations':               operations,
+            'errors':                   self.errors,
+            'delivered':                self.delivered,
+            'events_per_second':        self.delivered / elapsed,
+            'latency_p50_ms':           percentile(self.latencies, 0.5) * 1000,
+            'latency_p99_ms':           percentile(self.latencies, 0.99) * 1000,
+            'latency_p999_ms':          percentile(self.latencies, 0.999) * 1000,
+            'request_p50_ms':           percentile(self.request_latencies, 0.5) * 1000,
+            'request_p99_ms':           percentile(self.request_latencies, 0.99) * 1000,
+            'memory_per_connection_kb': (memory_after - memory_before) / connections / 1024,
+            'server_rss_mb':            memory_after / 1024 / 1024,
+            'server_ws_stats':          stats,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket load test of the server')
+    parser.add_argument('--users', type=int, default=100, help='users, each of them holds one socket')
+    parser.add_argument('--group-size', type=int, default=10, help='members of each group chat (fan-out of an event)')
+    parser.add_argument('--rate', type=float, default=100, help='operations per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for events after the load')
+    parser.add_argument('--mix', default='send=0.6,like=0.2,writing=0.2', help='weights of operations')
+    parser.add_argument('--concurrency', type=int, default=100, help='max concurrent HTTP requests')
+    parser.add_argument('--encoding', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--deflate', action='store_true', help='offer permessage-deflate')
+    parser.add_argument('--image-size', type=int, default=0, help='size of an image in every sent message')
+    parser.add_argument('--broker', choices=['local', 'sqlite'], default='local')
+    parser.add_argument('--json', help='file to write results to')
+    parser.add_argument('--keep', action='store_true', help="don't remove the scratch directory")
+    args = parser.parse_args()
+
+    if args.encoding == 'msgpack' and msgpack is None:
+        parser.error('msgpack is not installed')
+
+    workdir = tempfile.mkdtemp(prefix='onfine-load-')
+    port = free_port()
+    env = {
+        **os.environ,
+        'ONFINE_DB_URL':        'sqlite:///' + os.path.join(workdir, 'load.db'),
+        'ONFINE_BROKER':        args.broker,
+        'ONFINE_BROKER_DB':     os.path.join(workdir, 'broker.db'),
+        'ONFINE_BCRYPT_ROUNDS': os.environ.get('ONFINE_BCRYPT_ROUNDS', '4'),
+    }
+    server = Server(workdir, port, env)
+
+    try:
+        server.start()
+        result = asyncio.run(LoadTest(args, port).run(server))
+    finally:
+        server.stop()
+
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for key, value in result.items():
+        print(f'{key:26} {value:.2f}' if isinstance(value, float) else f'{key:26} {value}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import os
+
+
+def env_str(name: str, default: str) -> str:
+    return os.getenv(name, default)
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return default if value is None or value == '' else int(value)
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return default if value is None or value == '' else float(value)
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return default if value is None or value == '' else value.lower() in ('1', 'true', 'yes', 'on')
+
+
+# Real-time events broker: 'local' (single process) or 'sqlite' (several workers on one host)
+
+BROKER_BACKEND       = env_str('ONFINE_BROKER', 'local')
+BROKER_DB_PATH       = env_str('ONFINE_BROKER_DB', './broker.db')
+BROKER_POLL_INTERVAL = env_float('ONFINE_BROKER_POLL_INTERVAL', 0.02)
+BROKER_WORKER_TTL    = env_float('ONFINE_BROKER_WORKER_TTL', 30)
+
+# Outbound WebSocket queues: policy for slow consumers is 'drop' (skip new events) or 'disconnect'
+
+WS_QUEUE_SIZE   = env_int('ONFINE_WS_QUEUE_SIZE', 256)
+WS_SLOW_POLICY  = env_str('ONFINE_WS_SLOW_POLICY', 'drop')
+WS_SEND_TIMEOUT = env_float('ONFINE_WS_SEND_TIMEOUT', 10)
+# permessage-deflate is used if the client offers it (when the server is started by main.py)
+WS_PER_MESSAGE_DEFLATE = env_bool('ONFINE_WS_PER_MESSAGE_DEFLATE', True)
+
+# Images
+
+MAX_IMAGE_SIZE   = env_int('ONFINE_MAX_IMAGE_SIZE', 10 * 1024 * 1024)
+IMAGE_CHUNK_SIZE = env_int('ONFINE_IMAGE_CHUNK_SIZE', 64 * 1024)
+IMAGE_CACHE_SIZE = env_int('ONFINE_IMAGE_CACHE_SIZE', 64 * 1024 * 1024)
+
+# Database: profile 'production' tunes SQLite for concurrent access (WAL, busy timeout, mmap), 'default' keeps SQLite defaults
+
+DB_URL                  = env_str('ONFINE_DB_URL', 'sqlite:///database.db')
+DB_PROFILE              = env_str('ONFINE_DB_PROFILE', 'production')
+DB_SYNCHRONOUS          = env_str('ONFINE_DB_SYNCHRONOUS', 'NORMAL')
+DB_BUSY_TIMEOUT         = env_int('ONFINE_DB_BUSY_TIMEOUT', 5000) # ms
+DB_MMAP_SIZE            = env_int('ONFINE_DB_MMAP_SIZE', 256 * 1024 * 1024)
+DB_CACHE_SIZE           = env_int('ONFINE_DB_CACHE_SIZE', -64 * 1024) # negative value is size in KiB
+DB_POOL_SIZE            = env_int('ONFINE_DB_POOL_SIZE', 5)
+DB_MAX_OVERFLOW         = env_int('ONFINE_DB_MAX_OVERFLOW', 10)
+DB_POOL_TIMEOUT         = env_float('ONFINE_DB_POOL_TIMEOUT', 30)
+DB_MAINTENANCE_INTERVAL = env_float('ONFINE_DB_MAINTENANCE_INTERVAL', 600) # s, 0 disables checkpoint/optimize task
+
+# Auth tokens are stored in the database and cached by every worker for AUTH_CACHE_TTL seconds,
+# so logout at one worker is applied by others not later than this time
+
+AUTH_TOKEN_TTL  = env_float('ONFINE_AUTH_TOKEN_TTL', 30 * 24 * 3600)
+AUTH_CACHE_TTL  = env_float('ONFINE_AUTH_CACHE_TTL', 60)
+AUTH_CACHE_SIZE = env_int('ONFINE_AUTH_CACHE_SIZE', 100_000)
+
+# Passwords: bcrypt cost (hashes with other cost are rehashed at login) and process pool which runs it
+
+BCRYPT_ROUNDS        = env_int('ONFINE_BCRYPT_ROUNDS', 12)
+PASSWORD_WORKERS     = env_int('ONFINE_PASSWORD_WORKERS', 2)
+PASSWORD_QUEUE_LIMIT = env_int('ONFINE_PASSWORD_QUEUE_LIMIT', 64) # more concurrent requests get 503
+
+# Outbox of real-time events: dispatcher is woken up after commits and also polls the table,
+# claimed events which were not sent during the lease are sent again
+
+OUTBOX_BATCH_SIZE    = env_int('ONFINE_OUTBOX_BATCH_SIZE', 200)
+OUTBOX_POLL_INTERVAL = env_float('ONFINE_OUTBOX_POLL_INTERVAL', 0.5)
+OUTBOX_LEASE         = env_float('ONFINE_OUTBOX_LEASE', 30)
+
+
+# Members of chats are cached by every worker, the size is total count of cached members
+
+MEMBERSHIP_CACHE_SIZE = env_int('ONFINE_MEMBERSHIP_CACHE_SIZE', 1_000_000)
+
+# Presence: offline status is sent if the user didn't reconnect during PRESENCE_GRACE seconds,
+# status changes are sent in batches every PRESENCE_FLUSH_INTERVAL seconds
+
+PRESENCE_GRACE          = env_float('ONFINE_PRESENCE_GRACE', 5)
+PRESENCE_FLUSH_INTERVAL = env_float('ONFINE_PRESENCE_FLUSH_INTERVAL', 1)
+PRESENCE_CACHE_SIZE     = env_int('ONFINE_PRESENCE_CACHE_SIZE', 100_000) # users whose companions are cached
+
+# Public data of users (/user/users, /user/pub_keys) is cached by every worker, the size is count of users
+
+PROFILE_CACHE_SIZE = env_int('ONFINE_PROFILE_CACHE_SIZE', 100_000)
+
+# Metrics of requests, SQL statements and sockets at /metrics in Prometheus text format
+
+METRICS_ENABLED = env_bool('ONFINE_METRICS', True)
+
+# SQL statements which take ONFINE_SLOW_QUERY_MS or more are written to ONFINE_SLOW_QUERY_LOG as JSON lines
+# (with query plan at the first time of every statement shape), 0 disables it
+
+SLOW_QUERY_THRESHOLD = env_float('ONFINE_SLOW_QUERY_MS', 100)
+SLOW_QUERY_LOG       = env_str('ONFINE_SLOW_QUERY_LOG', './slow_queries.log')
+SLOW_QUERY_PARAMS    = env_bool('ONFINE_SLOW_QUERY_PARAMS', True) # values of parameters are written too
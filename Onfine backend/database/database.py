@@ -1,14 +1,115 @@
-from sqlalchemy import create_engine, event
+import asyncio
+import time
+from sqlalchemy import create_engine, event, make_url, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from config import (
+    DB_URL, DB_PROFILE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT, DB_MMAP_SIZE, DB_CACHE_SIZE,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_MAINTENANCE_INTERVAL, METRICS_ENABLED, SLOW_QUERY_THRESHOLD
+)
+from monitoring.metrics import observe_query, count_query_error
+from monitoring.slow_queries import slow_query_log
+
+
+def get_pragmas(profile: str) -> list[tuple[str, str | int]]:
+    if profile == 'default':
+        return []
+
+    if profile == 'production':
+        return [
+            # readers don't block writer and writer doesn't block readers
+            ('journal_mode', 'WAL'),
+            # in WAL mode it is safe against corruption, only last commits can be lost at power failure
+            ('synchronous',  DB_SYNCHRONOUS),
+            # wait for lock of other connection instead of "database is locked" error
+            ('busy_timeout', DB_BUSY_TIMEOUT),
+            ('mmap_size',    DB_MMAP_SIZE),
+            ('cache_size',   DB_CACHE_SIZE),
+            ('temp_store',   'MEMORY'),
+        ]
+
+    raise ValueError(f'Unknown database profile: {profile}')
+
+
+PRAGMAS = get_pragmas(DB_PROFILE)
 
 
 @event.listens_for(Engine, 'connect')
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute('PRAGMA foreign_keys=ON')
+
+    for name, value in PRAGMAS:
+        cursor.execute(f'PRAGMA {name}={value}')
+
     cursor.close()
 
-DB_URL = 'sqlite:///database.db'
-engine = create_engine(DB_URL)
-SessionMaker = sessionmaker(engine, autocommit=False, autoflush=False)
\ No newline at end of file
+
+if METRICS_ENABLED or SLOW_QUERY_THRESHOLD > 0:
+    # start times are a stack, because a statement can be executed while other one is running on the same connection
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # for sync sessions it's time until the first row, the rest is read by fetch
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+
+        if METRICS_ENABLED:
+            observe_query(statement, duration)
+
+        if SLOW_QUERY_THRESHOLD > 0 and duration >= slow_query_log.threshold:
+            try:
+                slow_query_log.record(conn, statement, parameters, executemany, duration)
+            except Exception:
+                pass # log must not break the request
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_query_error(context):
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+
+        if starts and context.statement is not None:
+            starts.pop()
+
+            if METRICS_ENABLED:
+                count_query_error(context.statement)
+
+
+# sync sessions are used by sync routes (they run in threadpool), async sessions by async routes
+
+pool_options = {
+    'pool_size':    DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+}
+
+engine = create_engine(DB_URL, poolclass=QueuePool, **pool_options)
+SessionMaker = sessionmaker(engine, autocommit=False, autoflush=False)
+
+ASYNC_DB_URL = make_url(DB_URL).set(drivername='sqlite+aiosqlite')
+async_engine = create_async_engine(ASYNC_DB_URL, poolclass=AsyncAdaptedQueuePool, **pool_options)
+AsyncSessionMaker = async_sessionmaker(async_engine, autocommit=False, autoflush=False, expire_on_commit=False)
+
+
+async def maintain_database():
+    '''
+    Periodically moves WAL content into the database file (so WAL doesn't grow
+    while there are always active readers) and lets SQLite refresh query planner statistics.
+    '''
+
+    if DB_MAINTENANCE_INTERVAL <= 0:
+        return
+
+    while True:
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+
+        try:
+            async with async_engine.connect() as conn:
+                await conn.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+                await conn.execute(text('PRAGMA optimize'))
+        except Exception:
+            pass # database is busy, try at next time
@@ -0,0 +1,127 @@
+import asyncio
+import json
+from typing import Iterable
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import MEMBERSHIP_CACHE_SIZE
+from database.models import Chat, ChatUser
+from realtime.broker import broker
+from tools import LRUCache
+
+
+class ChatMembers:
+    def __init__(self, type_: str):
+        self.type = type_
+        # user_id -> is_admin
+        self.members: dict[str, bool] = {}
+
+    def is_admin(self, user_id: str) -> bool | None:
+        # None means the user is not a member
+        return self.members.get(user_id)
+
+    def others(self, user_id: str) -> list[str]:
+        return [id_ for id_ in self.members if id_ != user_id]
+
+
+class MembershipCache(LRUCache):
+    '''
+    LRU cache of chat members of this worker, bounded by the total count of cached members.
+    Routes which change members invalidate it after commit, other workers get it through the broker.
+    '''
+
+    def sizeof(self, chat: ChatMembers) -> int:
+        return len(chat.members) + 1
+
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_SIZE)
+
+
+def __on_control(message: str):
+    data = json.loads(message)
+
+    if data.get('type') == 'membership':
+        membership_cache.invalidate(data['chat_ids'])
+
+broker.on_control(__on_control)
+
+
+def __query(chat_ids: list[str]):
+    return select(
+        Chat.id,
+        Chat.type,
+        ChatUser.user_id,
+        ChatUser.is_admin
+    ).where(
+        Chat.id.in_(chat_ids)
+    ).outerjoin(ChatUser, ChatUser.chat_id == Chat.id)
+
+def __collect(rows, chats: dict[str, ChatMembers], version: int):
+    loaded: dict[str, ChatMembers] = {}
+
+    for chat_id, type_, user_id, is_admin in rows:
+        chat = loaded.get(chat_id)
+
+        if chat is None:
+            chat = loaded[chat_id] = ChatMembers(type_)
+
+        if not user_id is None:
+            chat.members[user_id] = is_admin
+
+    for chat_id, chat in loaded.items():
+        membership_cache.put(chat_id, chat, version)
+
+    chats.update(loaded)
+
+def __from_cache(chat_ids: Iterable[str]) -> tuple[dict[str, ChatMembers], list[str], int]:
+    version = membership_cache.version
+    chats = {}
+    missing = []
+
+    for chat_id in set(chat_ids):
+        chat = membership_cache.get(chat_id)
+
+        if chat is None:
+            missing.append(chat_id)
+        else:
+            chats[chat_id] = chat
+
+    return chats, missing, version
+
+
+async def get_chats(sess: AsyncSession, chat_ids: Iterable[str]) -> dict[str, ChatMembers]:
+    '''Type and members of chats, chats which don't exist are not in the result.'''
+
+    chats, missing, version = __from_cache(chat_ids)
+
+    if missing:
+        __collect((await sess.execute(__query(missing))).tuples(), chats, version)
+
+    return chats
+
+def get_chats_sync(sess: Session, chat_ids: Iterable[str]) -> dict[str, ChatMembers]:
+    chats, missing, version = __from_cache(chat_ids)
+
+    if missing:
+        __collect(sess.execute(__query(missing)).tuples(), chats, version)
+
+    return chats
+
+async def get_chat(sess: AsyncSession, chat_id: str) -> ChatMembers | None:
+    return (await get_chats(sess, [chat_id])).get(chat_id)
+
+def get_chat_sync(sess: Session, chat_id: str) -> ChatMembers | None:
+    return get_chats_sync(sess, [chat_id]).get(chat_id)
+
+
+def invalidate_chats(chat_ids: Iterable[str]):
+    '''Called after commit which changed members of chats, at this and other workers.'''
+
+    chat_ids = list(chat_ids)
+
+    if chat_ids:
+        broker.send_control(json.dumps({ 'type': 'membership', 'chat_ids': chat_ids }))
+
+async def invalidate_chats_async(chat_ids: Iterable[str]):
+    # broker can write to its database, so it doesn't run in the event loop
+    await asyncio.to_thread(invalidate_chats, list(chat_ids))
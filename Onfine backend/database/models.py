@@ -1,6 +1,6 @@
 from typing_extensions import Annotated
 from enum import Enum
-from sqlalchemy import ForeignKey, String, Integer, Text, TIMESTAMP
+from sqlalchemy import ForeignKey, String, Integer, Text, TIMESTAMP, Index, text
 from sqlalchemy.orm import DeclarativeBase, registry, Mapped, mapped_column, relationship
 from datetime import datetime
 from tools import get_UUID, get_now_datetime
@@ -8,6 +8,7 @@ from tools import get_UUID, get_now_datetime
 
 uuid    = Annotated[String, 32]
 str_50  = Annotated[String, 50]
+str_64  = Annotated[String, 64]
 str_255 = Annotated[String, 255]
 
 class Base(DeclarativeBase):
@@ -15,6 +16,7 @@ class Base(DeclarativeBase):
         type_annotation_map={
             uuid:     String(32),
             str_50:   String(50),
+            str_64:   String(64),
             str_255:  String(255),
             str:      Text,
             int:      Integer,
@@ -40,6 +42,13 @@ class ChatUser(Base):
     key:      Mapped[str]  = mapped_column(nullable=True, default=None)
     unread_count: Mapped[int] = mapped_column(default=0)
 
+class ChatUnreadSender(Base):
+    __tablename__ = 'chat_unread_senders'
+
+    # users who sent messages to the chat since it was read last time
+    chat_id: Mapped[uuid] = mapped_column(ForeignKey('chats.id', ondelete='CASCADE'), primary_key=True)
+    user_id: Mapped[uuid] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+
 class Like(Base):
     __tablename__ = 'likes'
 
@@ -60,12 +69,19 @@ class User(Base):
     pub_key:     Mapped[str]
     priv_key:    Mapped[str]
     latest_key_update: Mapped[datetime] = mapped_column(default=get_now_datetime)
+    # incremented when name, nickname or avatar is changed, it's a part of ETag of /user/users
+    profile_version:   Mapped[int]      = mapped_column(default=0, server_default='0')
 
     message_likes:   Mapped[list['Message']] = relationship(back_populates='user_likes', secondary='likes')
     messages:        Mapped[list['Message']] = relationship(back_populates='sender', foreign_keys='Message.sender_id')
     reply_list:      Mapped[list['Message']] = relationship(back_populates='reply_sender', foreign_keys='Message.reply_sender_id')
     chats:           Mapped[list['Chat']]    = relationship(back_populates='users', secondary='chat_user')
 
+    __table_args__ = (
+        # prefix search of short values, it's case-insensitive
+        Index('ix_users_nickname_lower', text('lower(nickname)')),
+    )
+
 class Message(Base):
     __tablename__ = 'messages'
 
@@ -74,6 +90,7 @@ class Message(Base):
     with_image:    Mapped[bool]     = mapped_column(default=False)
     date_time:     Mapped[datetime] = mapped_column(default=get_now_datetime)
     reply_content: Mapped[str]      = mapped_column(nullable=True)
+    likes_count:   Mapped[int]      = mapped_column(default=0, server_default='0')
 
     sender_id: Mapped[uuid]   = mapped_column(ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
     sender:    Mapped['User'] = relationship(back_populates='messages', foreign_keys=[sender_id])
@@ -86,6 +103,11 @@ class Message(Base):
     chat_id: Mapped[uuid]   = mapped_column(ForeignKey('chats.id', ondelete='CASCADE'))
     chat:    Mapped['Chat'] = relationship(back_populates='messages')
 
+    __table_args__ = (
+        # history of chat, sorted by (date_time, id) for keyset pagination
+        Index('ix_messages_chat_id_date_time', 'chat_id', 'date_time', 'id'),
+    )
+
 class Chat(Base):
     __tablename__ = 'chats'
 
@@ -96,8 +118,40 @@ class Chat(Base):
     with_icon:      Mapped[bool]     = mapped_column(default=False)
     is_private:     Mapped[bool]
     members_count:  Mapped[int]
-    unread_senders: Mapped[str]      = mapped_column(default='')
     last_reading:   Mapped[datetime] = mapped_column(default=get_now_datetime)
 
+    # copy of the latest message, kept by message routes for the chat list
+    last_message_id:        Mapped[uuid]     = mapped_column(nullable=True)
+    last_message_content:   Mapped[str]      = mapped_column(nullable=True)
+    last_message_datetime:  Mapped[datetime] = mapped_column(nullable=True)
+    last_message_sender_id: Mapped[uuid]     = mapped_column(ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+
     users:    Mapped[list['User']]    = relationship(back_populates='chats', secondary='chat_user')
     messages: Mapped[list['Message']] = relationship(back_populates='chat')
+
+    __table_args__ = (
+        # prefix search of short values, it's case-insensitive
+        Index('ix_chats_name_lower', text('lower(name)')),
+    )
+
+
+class AuthToken(Base):
+    __tablename__ = 'auth_tokens'
+
+    # sha256 of token, so tokens can't be taken from the database
+    token_hash: Mapped[str_64]   = mapped_column(primary_key=True)
+    user_id:    Mapped[uuid]     = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), index=True)
+    created_at: Mapped[datetime] = mapped_column(default=get_now_datetime)
+    expires_at: Mapped[datetime]
+
+
+class OutboxEvent(Base):
+    __tablename__ = 'outbox'
+
+    id:            Mapped[int]      = mapped_column(primary_key=True, autoincrement=True)
+    # JSON list of recipients, NULL means all online users
+    user_ids:      Mapped[str]      = mapped_column(nullable=True)
+    message:       Mapped[str]
+    created_at:    Mapped[datetime] = mapped_column(default=get_now_datetime)
+    claimed_until: Mapped[datetime] = mapped_column(nullable=True)
+    attempts:      Mapped[int]      = mapped_column(default=0)
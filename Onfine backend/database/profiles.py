@@ -0,0 +1,94 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import Iterable
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from config import PROFILE_CACHE_SIZE
+from database.models import User
+from realtime.broker import broker
+from tools import LRUCache
+
+
+class UserProfile:
+    def __init__(self, name: str, nickname: str, with_avatar: bool, last_visit: datetime,
+                 profile_version: int, pub_key: str, latest_key_update: datetime):
+        self.name = name
+        self.nickname = nickname
+        self.with_avatar = with_avatar
+        self.last_visit = last_visit
+        self.profile_version = profile_version
+        self.pub_key = pub_key
+        self.latest_key_update = latest_key_update
+
+
+# cached for IDs of users who don't exist, because deleted users are still requested by their companions
+NO_USER = UserProfile('', '', False, datetime.min, 0, '', datetime.min)
+
+
+class ProfileCache(LRUCache):
+    '''
+    LRU cache of public data of users (user id -> profile) of this worker. Routes which change it
+    invalidate it after commit, other workers get it through the broker.
+    '''
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE)
+
+
+def __on_control(message: str):
+    data = json.loads(message)
+
+    if data.get('type') == 'profiles':
+        profile_cache.invalidate(data['user_ids'])
+
+broker.on_control(__on_control)
+
+
+def get_profiles(sess: Session, user_ids: Iterable[str]) -> dict[str, UserProfile]:
+    '''Profiles of users, users who don't exist are not in the result.'''
+
+    version = profile_cache.version
+    profiles = {}
+    missing = []
+
+    for user_id in set(user_ids):
+        profile = profile_cache.get(user_id)
+
+        if profile is None:
+            missing.append(user_id)
+        elif not profile is NO_USER:
+            profiles[user_id] = profile
+
+    if missing:
+        query = select(
+            User.id,
+            User.name,
+            User.nickname,
+            User.with_avatar,
+            User.last_visit,
+            User.profile_version,
+            User.pub_key,
+            User.latest_key_update
+        ).where(User.id.in_(missing))
+
+        for user_id, *fields in sess.execute(query).tuples():
+            profiles[user_id] = UserProfile(*fields)
+
+        for user_id in missing:
+            profile_cache.put(user_id, profiles.get(user_id, NO_USER), version)
+
+    return profiles
+
+
+def invalidate_profiles(user_ids: Iterable[str]):
+    '''Called after commit which changed users, at this and other workers.'''
+
+    user_ids = list(user_ids)
+
+    if user_ids:
+        broker.send_control(json.dumps({ 'type': 'profiles', 'user_ids': user_ids }))
+
+async def invalidate_profiles_async(user_ids: Iterable[str]):
+    # broker can write to its database, so it doesn't run in the event loop
+    await asyncio.to_thread(invalidate_profiles, list(user_ids))
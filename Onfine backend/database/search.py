@@ -0,0 +1,51 @@
+from sqlalchemy import table, column, case, func
+from sqlalchemy.orm import Query
+from database.models import User, Chat
+
+# FTS5 tables with trigram tokenizer (created by migration). They keep id of users/chats
+# and are kept in sync by triggers, so any substring of 3+ chars is found through the index.
+# Other comparisons use SQLite lower() on both sides, it folds only ASCII letters, so they are
+# case-insensitive for latin letters only (e.g. not for cyrillic), like istartswith (LIKE) is.
+
+users_fts = table('users_fts', column('id'), column('nickname'), column('rank'))
+chats_fts = table('chats_fts', column('id'), column('name'), column('rank'))
+
+MIN_MATCH_LENGTH = 3
+
+
+def fts_phrase(value: str) -> str:
+    # value is matched as one phrase, so user input can't use FTS query syntax
+    return '"' + value.replace('"', '""') + '"'
+
+
+def __search(query: Query, value: str, search_column, id_column, fts, fts_column) -> Query:
+    if len(value) < MIN_MATCH_LENGTH:
+        # trigrams can't find shorter values, so only prefix is matched through index of lower(column)
+        lower_column = func.lower(search_column)
+        lower_value = func.lower(value)
+
+        return query.filter(
+            lower_column >= lower_value,
+            lower_column < lower_value + '\U0010ffff'
+        ).order_by(lower_column)
+
+    # exact match, then prefix match, then by bm25 rank of substring match
+    order = case(
+        (func.lower(search_column) == func.lower(value), 0),
+        (search_column.istartswith(value, autoescape=True), 1),
+        else_=2
+    )
+
+    return query.join(
+        fts, fts.c.id == id_column
+    ).filter(
+        fts_column.match(fts_phrase(value))
+    ).order_by(order, fts.c.rank, func.length(search_column))
+
+
+def search_users(query: Query, value: str) -> Query:
+    return __search(query, value, User.nickname, User.id, users_fts, users_fts.c.nickname)
+
+
+def search_chats(query: Query, value: str) -> Query:
+    return __search(query, value, Chat.name, Chat.id, chats_fts, chats_fts.c.name)
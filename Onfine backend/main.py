@@ -1,22 +1,48 @@
+import asyncio
+from contextlib import asynccontextmanager
 import uvicorn
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from sqlalchemy import and_, select
-from sqlalchemy.orm import aliased
+from fastapi.responses import RedirectResponse, PlainTextResponse
 import models.requests as reque
-import models.responses as resp
-from database.database import SessionMaker
-from database.models import User, ChatUser, Chat, ChatTypes
-from tools import check_auth, parse_model, json_response, connected_clients, get_now_datetime, logout_user
+from config import WS_PER_MESSAGE_DEFLATE, METRICS_ENABLED, SLOW_QUERY_THRESHOLD
+from database.database import async_engine, maintain_database
+from database.membership import membership_cache
+from database.profiles import profile_cache
+from monitoring.metrics import registry
+from monitoring.middleware import MetricsMiddleware
+from monitoring.slow_queries import slow_query_log
+from tools import parse_model, json_response, image_cache
+from security.tokens import check_auth_async, logout_user_async
+from security.passwords import password_hasher
+from realtime.broker import broker
+from realtime.connections import manager, ENCODINGS
+from realtime.outbox import outbox
+from realtime.presence import presence
 
 from routes.chat import router as chat_router
 from routes.user import router as user_router
 from routes.message import router as message_router
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await broker.start()
+    await outbox.start()
+    await presence.start()
+    password_hasher.start()
+    maintenance_task = asyncio.create_task(maintain_database())
+    yield
+    maintenance_task.cancel()
+    password_hasher.stop()
+    await presence.stop()
+    await outbox.stop()
+    await broker.stop()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(chat_router)
 app.include_router(user_router)
 app.include_router(message_router)
@@ -26,9 +52,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_origins=['*'],
     allow_methods=['*'],
-    allow_headers=['*']
+    allow_headers=['*'],
+    expose_headers=['X-Next-Cursor']
 )
 
+if METRICS_ENABLED or SLOW_QUERY_THRESHOLD > 0:
+    # added last, so it's the outermost and measures other middlewares too,
+    # it also tells the slow query log which route a statement comes from
+    app.add_middleware(MetricsMiddleware)
+
 app.mount('/view', StaticFiles(directory='view', html=True), name='view')
 app.mount('/images', StaticFiles(directory='images'), name='images')
 
@@ -38,29 +70,25 @@ def view():
     return RedirectResponse(url='/view')
 
 
-async def send_user_status(user_id: str, is_online: bool):
-    with SessionMaker() as sess:
-        chatUser1: ChatUser = aliased(ChatUser)
-        chatUser2: ChatUser = aliased(ChatUser)
+@app.get('/ws/stats', response_model=dict)
+def ws_stats():
+    return manager.stats()
 
-        query = select(chatUser2.user_id).where(
-            Chat.type == ChatTypes.chat.name
-        ).join(
-            chatUser1, and_(
-            chatUser1.chat_id == Chat.id,
-            chatUser1.user_id == user_id
-        )).join(
-            chatUser2, and_(
-            chatUser2.chat_id == Chat.id,
-            chatUser2.user_id != user_id
-        ))
-        user_ids: list[str] = sess.execute(query).scalars().all()
 
-    notifi = resp.NewStatus(user_id=user_id, is_online=is_online).model_dump_json()
+if METRICS_ENABLED:
+    registry.add_stats('ws', manager.stats)
+    registry.add_stats('outbox', outbox.stats)
+    registry.add_stats('presence', presence.stats)
+    registry.add_stats('password_hasher', password_hasher.stats)
+    registry.add_stats('membership_cache', membership_cache.stats)
+    registry.add_stats('profile_cache', profile_cache.stats)
+    registry.add_stats('image_cache', image_cache.stats)
+    registry.add_stats('slow_queries', slow_query_log.stats)
 
-    for id_ in user_ids:
-        if id_ in connected_clients:
-            await connected_clients[id_].send_text(notifi)
+    # async, so stats of sockets are read in the event loop which changes them
+    @app.get('/metrics', response_class=PlainTextResponse, include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.websocket('/ws')
@@ -68,35 +96,35 @@ async def ws(socket: WebSocket):
     await socket.accept()
 
     data: dict = await socket.receive_json()
-    auth_data: reque.Auth | None = parse_model(reque.Auth, **data)
+    auth_data: reque.SocketAuth | None = parse_model(reque.SocketAuth, **data)
 
     if auth_data is None:
         await json_response(socket, 'Wrong parameters', 400)
         return
     
-    if not check_auth(auth_data):
+    if not auth_data.encoding in ENCODINGS:
+        await json_response(socket, 'Encoding is not supported', 400)
+        return
+
+    if not await check_auth_async(auth_data):
         await json_response(socket, 'Wrong token', 401)
         return
 
     user_id = auth_data.user_id
 
-    await send_user_status(user_id, True)
-    connected_clients[user_id] = socket
+    await broker.connect(user_id, socket, auth_data.encoding)
+    presence.connect(user_id)
 
     try:
         while True:
             await socket.receive_text()
     finally:
-        connected_clients.pop(user_id)
-
-        with SessionMaker.begin() as sess:
-            sess.query(User).filter(User.id == user_id).update({
-                User.last_visit: get_now_datetime()
-            })
+        await broker.disconnect(user_id, socket)
+        # last visit is written by presence service, when offline status is sent
+        presence.disconnect(user_id)
 
-        logout_user(user_id)
-        await send_user_status(user_id, False)
+        await logout_user_async(user_id, auth_data.token)
 
 
 if __name__ == '__main__':
-    uvicorn.run('main:app', host='0.0.0.0', port=8000)
+    uvicorn.run('main:app', host='0.0.0.0', port=8000, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
@@ -6,6 +6,7 @@ from sqlalchemy import pool
 from alembic import context
 
 from database.models import metadata
+from config import DB_URL
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -16,6 +17,9 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# database is selected by ONFINE_DB_URL like in the server
+config.set_main_option("sqlalchemy.url", DB_URL.replace("%", "%%"))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
@@ -28,6 +32,13 @@ target_metadata = metadata
 # ... etc.
 
 
+def include_name(name, type_, parent_names) -> bool:
+    # FTS5 search tables and their shadow tables are created by hand in migrations
+    if type_ == "table":
+        return not (name.endswith("_fts") or "_fts_" in name)
+    return True
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -46,6 +57,8 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        render_as_batch=True,
+        include_name=include_name,
     )
 
     with context.begin_transaction():
@@ -66,8 +79,16 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # batch operations recreate tables, which must not fire cascades
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+            connection.commit()
+
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+            include_name=include_name,
         )
 
         with context.begin_transaction():
@@ -0,0 +1,29 @@
+"""user profile version
+
+Revision ID: 3b7d2e91c4f6
+Revises: 9f2b33494240
+Create Date: 2026-10-18 11:02:47.215306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b7d2e91c4f6'
+down_revision: Union[str, None] = '9f2b33494240'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# users are changed by native ALTER TABLE, batch mode would recreate the table,
+# which renumbers rowids of users_fts index and drops its triggers
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('profile_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'profile_version')
@@ -0,0 +1,32 @@
+"""message likes count
+
+Revision ID: 5c0e2f8a9d14
+Revises: 37516c01da85
+Create Date: 2026-10-18 07:52:10.418233
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0e2f8a9d14'
+down_revision: Union[str, None] = '37516c01da85'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('messages', sa.Column('likes_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute('''
+        UPDATE messages SET likes_count = (
+            SELECT count(*) FROM likes WHERE likes.message_id = messages.id
+        )
+    ''')
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('likes_count')
@@ -0,0 +1,55 @@
+"""chat last message
+
+Revision ID: 8e41b7d0c3a2
+Revises: 5c0e2f8a9d14
+Create Date: 2026-10-18 08:04:37.902114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e41b7d0c3a2'
+down_revision: Union[str, None] = '5c0e2f8a9d14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.add_column(sa.Column('last_message_id', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('last_message_content', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('last_message_datetime', sa.TIMESTAMP(timezone=True), nullable=True))
+        batch_op.add_column(sa.Column('last_message_sender_id', sa.String(length=32), nullable=True))
+        batch_op.create_foreign_key(
+            'fk_chats_last_message_sender_id_users', 'users',
+            ['last_message_sender_id'], ['id'], ondelete='SET NULL'
+        )
+
+    op.execute('''
+        UPDATE chats SET last_message_id = (
+            SELECT id FROM messages
+            WHERE messages.chat_id = chats.id
+            ORDER BY date_time DESC, id DESC
+            LIMIT 1
+        )
+    ''')
+    op.execute('''
+        UPDATE chats SET
+            last_message_content   = (SELECT content   FROM messages WHERE messages.id = chats.last_message_id),
+            last_message_datetime  = (SELECT date_time FROM messages WHERE messages.id = chats.last_message_id),
+            last_message_sender_id = (SELECT sender_id FROM messages WHERE messages.id = chats.last_message_id)
+        WHERE last_message_id IS NOT NULL
+    ''')
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.drop_constraint('fk_chats_last_message_sender_id_users', type_='foreignkey')
+        batch_op.drop_column('last_message_sender_id')
+        batch_op.drop_column('last_message_datetime')
+        batch_op.drop_column('last_message_content')
+        batch_op.drop_column('last_message_id')
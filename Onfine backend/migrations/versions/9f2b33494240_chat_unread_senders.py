@@ -0,0 +1,58 @@
+"""chat unread senders
+
+Revision ID: 9f2b33494240
+Revises: e0cd97c16afb
+Create Date: 2026-10-18 10:21:38.963939
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9f2b33494240'
+down_revision: Union[str, None] = 'e0cd97c16afb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('chat_unread_senders',
+    sa.Column('chat_id', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.String(length=32), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('chat_id', 'user_id')
+    )
+
+    # 'id1;id2;id1;' strings -> distinct rows
+    op.execute('''
+        WITH RECURSIVE split(chat_id, user_id, rest) AS (
+            SELECT id, '', unread_senders || ';' FROM chats WHERE unread_senders != ''
+            UNION ALL
+            SELECT chat_id, substr(rest, 1, instr(rest, ';') - 1), substr(rest, instr(rest, ';') + 1)
+            FROM split WHERE rest != ''
+        )
+        INSERT OR IGNORE INTO chat_unread_senders (chat_id, user_id)
+        SELECT chat_id, user_id FROM split
+        WHERE user_id != '' AND user_id IN (SELECT id FROM users)
+    ''')
+
+    # not in batch mode: recreating chats would change its rowids, which chats_fts index refers to
+    op.drop_column('chats', 'unread_senders')
+
+
+def downgrade() -> None:
+    op.add_column('chats', sa.Column('unread_senders', sa.Text(), nullable=False, server_default=''))
+
+    op.execute('''
+        UPDATE chats SET unread_senders = (
+            SELECT group_concat(user_id || ';', '') FROM chat_unread_senders
+            WHERE chat_unread_senders.chat_id = chats.id
+        )
+        WHERE id IN (SELECT chat_id FROM chat_unread_senders)
+    ''')
+
+    op.drop_table('chat_unread_senders')
@@ -0,0 +1,89 @@
+"""search index
+
+Revision ID: c0e5ff945cc5
+Revises: 8e41b7d0c3a2
+Create Date: 2026-10-18 08:52:11.406215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c0e5ff945cc5'
+down_revision: Union[str, None] = '8e41b7d0c3a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# External content FTS5 tables: text is read from users/chats by rowid, index is kept by triggers.
+# Only public chats with a name are indexed, so 'rebuild' command must not be used for chats_fts.
+# Migrations which recreate users or chats table (batch mode) have to recreate these triggers and refill the index.
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_chats_name'), 'chats', ['name'], unique=False)
+
+    op.execute('''
+        CREATE VIRTUAL TABLE users_fts USING fts5(
+            nickname, content='users', content_rowid='rowid', tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, nickname) VALUES (new.rowid, new.nickname);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname) VALUES ('delete', old.rowid, old.nickname);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_update AFTER UPDATE OF nickname ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname) VALUES ('delete', old.rowid, old.nickname);
+            INSERT INTO users_fts (rowid, nickname) VALUES (new.rowid, new.nickname);
+        END
+    ''')
+    op.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    op.execute('''
+        CREATE VIRTUAL TABLE chats_fts USING fts5(
+            name, content='chats', content_rowid='rowid', tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_insert AFTER INSERT ON chats
+        WHEN new.is_private = 0 AND new.name IS NOT NULL BEGIN
+            INSERT INTO chats_fts (rowid, name) VALUES (new.rowid, new.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats
+        WHEN old.is_private = 0 AND old.name IS NOT NULL BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_update AFTER UPDATE OF name, is_private ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, name)
+                SELECT 'delete', old.rowid, old.name WHERE old.is_private = 0 AND old.name IS NOT NULL;
+            INSERT INTO chats_fts (rowid, name)
+                SELECT new.rowid, new.name WHERE new.is_private = 0 AND new.name IS NOT NULL;
+        END
+    ''')
+    op.execute('''
+        INSERT INTO chats_fts (rowid, name)
+            SELECT rowid, name FROM chats WHERE is_private = 0 AND name IS NOT NULL
+    ''')
+
+
+def downgrade() -> None:
+    for name in ('chats_fts_update', 'chats_fts_delete', 'chats_fts_insert', 'users_fts_update', 'users_fts_delete', 'users_fts_insert'):
+        op.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    op.execute('DROP TABLE IF EXISTS chats_fts')
+    op.execute('DROP TABLE IF EXISTS users_fts')
+
+    op.drop_index(op.f('ix_chats_name'), table_name='chats')
@@ -0,0 +1,158 @@
+"""search index by id
+
+Revision ID: d6a4f1c8b273
+Revises: 3b7d2e91c4f6
+Create Date: 2026-10-18 14:20:36.518042
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd6a4f1c8b273'
+down_revision: Union[str, None] = '3b7d2e91c4f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# users and chats have text primary keys, so their rowids are renumbered by VACUUM or by batch mode,
+# which made external content FTS tables point to wrong rows. Now FTS tables keep their own copy
+# of the text with id of the row (UNINDEXED), and searches join them by id.
+# Deletes from FTS tables by id scan them, it's fine as nicknames and public chats change rarely.
+# Batch mode still drops triggers of the table, such migrations have to recreate them.
+#
+# Short values are searched by prefix of lower(...), which is indexed here too.
+
+FTS_TRIGGERS = ('chats_fts_update', 'chats_fts_delete', 'chats_fts_insert', 'users_fts_update', 'users_fts_delete', 'users_fts_insert')
+
+
+def drop_fts():
+    for name in FTS_TRIGGERS:
+        op.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    op.execute('DROP TABLE IF EXISTS chats_fts')
+    op.execute('DROP TABLE IF EXISTS users_fts')
+
+
+def upgrade() -> None:
+    drop_fts()
+
+    op.execute('''
+        CREATE VIRTUAL TABLE users_fts USING fts5(
+            id UNINDEXED, nickname, tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (id, nickname) VALUES (new.id, new.nickname);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_fts WHERE id = old.id;
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_update AFTER UPDATE OF nickname ON users BEGIN
+            UPDATE users_fts SET nickname = new.nickname WHERE id = old.id;
+        END
+    ''')
+    op.execute('INSERT INTO users_fts (id, nickname) SELECT id, nickname FROM users')
+
+    op.execute('''
+        CREATE VIRTUAL TABLE chats_fts USING fts5(
+            id UNINDEXED, name, tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_insert AFTER INSERT ON chats
+        WHEN new.is_private = 0 AND new.name IS NOT NULL BEGIN
+            INSERT INTO chats_fts (id, name) VALUES (new.id, new.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats
+        WHEN old.is_private = 0 AND old.name IS NOT NULL BEGIN
+            DELETE FROM chats_fts WHERE id = old.id;
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_update AFTER UPDATE OF name, is_private ON chats BEGIN
+            DELETE FROM chats_fts WHERE id = old.id AND old.is_private = 0 AND old.name IS NOT NULL;
+            INSERT INTO chats_fts (id, name)
+                SELECT new.id, new.name WHERE new.is_private = 0 AND new.name IS NOT NULL;
+        END
+    ''')
+    op.execute('''
+        INSERT INTO chats_fts (id, name)
+            SELECT id, name FROM chats WHERE is_private = 0 AND name IS NOT NULL
+    ''')
+
+    op.drop_index('ix_chats_name', table_name='chats')
+    op.create_index('ix_chats_name_lower', 'chats', [sa.text('lower(name)')], unique=False)
+    op.create_index('ix_users_nickname_lower', 'users', [sa.text('lower(nickname)')], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_nickname_lower', table_name='users')
+    op.drop_index('ix_chats_name_lower', table_name='chats')
+    op.create_index('ix_chats_name', 'chats', ['name'], unique=False)
+
+    drop_fts()
+
+    # the same index as c0e5ff945cc5 made
+    op.execute('''
+        CREATE VIRTUAL TABLE users_fts USING fts5(
+            nickname, content='users', content_rowid='rowid', tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, nickname) VALUES (new.rowid, new.nickname);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname) VALUES ('delete', old.rowid, old.nickname);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER users_fts_update AFTER UPDATE OF nickname ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname) VALUES ('delete', old.rowid, old.nickname);
+            INSERT INTO users_fts (rowid, nickname) VALUES (new.rowid, new.nickname);
+        END
+    ''')
+    op.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    op.execute('''
+        CREATE VIRTUAL TABLE chats_fts USING fts5(
+            name, content='chats', content_rowid='rowid', tokenize='trigram'
+        )
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_insert AFTER INSERT ON chats
+        WHEN new.is_private = 0 AND new.name IS NOT NULL BEGIN
+            INSERT INTO chats_fts (rowid, name) VALUES (new.rowid, new.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_delete AFTER DELETE ON chats
+        WHEN old.is_private = 0 AND old.name IS NOT NULL BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+        END
+    ''')
+    op.execute('''
+        CREATE TRIGGER chats_fts_update AFTER UPDATE OF name, is_private ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, name)
+                SELECT 'delete', old.rowid, old.name WHERE old.is_private = 0 AND old.name IS NOT NULL;
+            INSERT INTO chats_fts (rowid, name)
+                SELECT new.rowid, new.name WHERE new.is_private = 0 AND new.name IS NOT NULL;
+        END
+    ''')
+    op.execute('''
+        INSERT INTO chats_fts (rowid, name)
+            SELECT rowid, name FROM chats WHERE is_private = 0 AND name IS NOT NULL
+    ''')
@@ -7,6 +7,10 @@ class Auth(BaseModel):
     user_id: str
     token: str
 
+class SocketAuth(Auth):
+    # format of events: JSON text frames or MessagePack binary frames
+    encoding: Literal['json', 'msgpack'] = 'json'
+
 class Login(BaseModel):
     email: EmailStr = Field(max_length=50)
     password: str   = Field(min_length=6, max_length=255)
@@ -41,18 +45,20 @@ class DeleteUser(BaseModel):
     password: str = Field(min_length=6, max_length=255)
 
 class SearchUsers(Auth):
-    value: str
+    value: str = Field(min_length=1, max_length=50)
     chat_id: str | None = None
+    limit: int = Field(ge=1, le=50, default=20)
+    offset: int = Field(ge=0, le=1000, default=0)
 
 
 class GetPosts(Auth):
-    start_date_time: datetime
+    start_date_time: datetime | None = None
+    cursor: str | None = None
     limit: int = Field(ge=1, default=20)
+    inline_images: bool = True
 
-class GetMessages(Auth):
+class GetMessages(GetPosts):
     chat_id: str
-    start_date_time: datetime
-    limit: int = Field(ge=1, default=20)
 
 class ChatData(Auth):
     chat_id: str
@@ -52,6 +52,7 @@ class Post(BaseModel):
     sender_id: str
     content: str
     image: str | None
+    image_url: str | None = None
     date_time: datetime
     likes: int = Field(ge=0, default=0)
     is_liked: bool = False
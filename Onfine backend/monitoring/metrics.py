@@ -0,0 +1,226 @@
+import bisect
+import re
+import threading
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Callable, Iterable
+
+
+# Metrics in Prometheus text format. Updates take a lock and a few dict operations,
+# so they are cheap enough to be made on every request, SQL statement and socket send.
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+
+    return str(int(value))
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+
+    pairs = []
+
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+
+        return self.header() + [
+            f'{self.name}{format_labels(self.labels, labels)} {format_value(value)}'
+            for labels, value in values
+        ]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, labels: tuple = ()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, labels: tuple = (), value: float = 1):
+        self.inc(labels, -value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: Iterable[float] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        # labels -> [count in every bucket (not cumulative) and above the last one, sum, count]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(labels)
+
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = [(labels, list(counts), sum_, count) for labels, (counts, sum_, count) in self.series.items()]
+
+        lines = self.header()
+        names = self.labels + ('le',)
+
+        for labels, counts, sum_, count in series:
+            total = 0
+
+            for bound, bucket_count in zip(self.buckets + [float('inf')], counts):
+                total += bucket_count
+                le = '+Inf' if bound == float('inf') else format_value(bound)
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (le,))} {total}')
+
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {format_value(sum_)}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {count}')
+
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics: list[Metric] = []
+        # prefix of names -> function which returns stats() of a component
+        self.stats: dict[str, Callable[[], dict]] = {}
+
+    def add(self, metric: Metric) -> Metric:
+        metric.name = f'{self.prefix}_{metric.name}'
+        self.metrics.append(metric)
+        return metric
+
+    def add_stats(self, name: str, stats: Callable[[], dict]):
+        '''Numbers from stats() of a component are read at scrape time as gauges, nested dicts get `key` label.'''
+
+        self.stats[name] = stats
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics:
+            lines += metric.render()
+
+        for name, stats in self.stats.items():
+            for key, value in stats().items():
+                metric_name = f'{self.prefix}_{name}_{key}'
+
+                if isinstance(value, dict):
+                    values = [(f'{{key="{sub_key}"}}', sub_value) for sub_key, sub_value in value.items()]
+                else:
+                    values = [('', value)]
+
+                values = [(labels, value) for labels, value in values if isinstance(value, (int, float))]
+
+                if values:
+                    lines.append(f'# TYPE {metric_name} gauge')
+                    lines += [f'{metric_name}{labels} {format_value(value)}' for labels, value in values]
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry('onfine')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS   = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+FANOUT_BUCKETS  = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+http_duration = registry.add(Histogram(
+    'http_request_duration_seconds', 'Time of HTTP requests by route template.', ('method', 'route'), LATENCY_BUCKETS
+))
+http_requests = registry.add(Counter(
+    'http_requests_total', 'HTTP responses by route template and status.', ('method', 'route', 'status')
+))
+http_in_progress = registry.add(Gauge(
+    'http_requests_in_progress', 'HTTP requests which are being handled.'
+))
+query_duration = registry.add(Histogram(
+    'db_query_duration_seconds', 'Time of SQL statements by route, operation and table.', ('route', 'operation', 'table'), QUERY_BUCKETS
+))
+query_errors = registry.add(Counter(
+    'db_query_errors_total', 'SQL statements which raised an error.', ('route', 'operation', 'table')
+))
+ws_fanout = registry.add(Histogram(
+    'ws_fanout_recipients', 'Sockets of this worker which an event is queued to.', (), FANOUT_BUCKETS
+))
+ws_send_duration = registry.add(Histogram(
+    'ws_send_duration_seconds', 'Time of writing a frame to a socket.', (), QUERY_BUCKETS
+))
+
+
+# ASGI scope of the request which is handled in this context, set by MetricsMiddleware.
+# Routes which run in threadpool and their SQL statements see it too, as context is copied there.
+request_scope: ContextVar[dict | None] = ContextVar('request_scope', default=None)
+
+def route_name(scope: dict | None = None) -> str:
+    '''Path template of the route, so metrics of /chat/{id} don't grow with IDs.'''
+
+    if scope is None:
+        scope = request_scope.get()
+
+    if scope is None:
+        return 'background' # outbox, presence, maintenance
+
+    route = scope.get('route')
+
+    if route is not None:
+        return route.path
+
+    # mounted static files or not found
+    return scope.get('root_path') or 'unmatched'
+
+
+TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def statement_labels(statement: str) -> tuple[str, str]:
+    '''Operation and the first table of a statement, SQLAlchemy reuses statement strings, so they are cached.'''
+
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    match = TABLE_PATTERN.search(statement)
+    return operation, match.group(1) if match else ''
+
+def observe_query(statement: str, duration: float):
+    query_duration.observe(duration, (route_name(),) + statement_labels(statement))
+
+def count_query_error(statement: str):
+    query_errors.inc((route_name(),) + statement_labels(statement))
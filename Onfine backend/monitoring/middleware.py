@@ -0,0 +1,51 @@
+import time
+from monitoring.metrics import request_scope, route_name, http_duration, http_requests, http_in_progress
+
+
+class MetricsMiddleware:
+    '''
+    Pure ASGI middleware (it doesn't buffer responses like BaseHTTPMiddleware): measures HTTP requests
+    and keeps their scope in a context variable, so SQL statements know which route they come from.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not scope['type'] in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        token = request_scope.set(scope)
+
+        try:
+            if scope['type'] == 'websocket':
+                await self.app(scope, receive, send)
+            else:
+                await self.__handle(scope, receive, send)
+        finally:
+            request_scope.reset(token)
+
+    async def __handle(self, scope, receive, send):
+        # it stays 500 if the app fails before the response is started
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+            await send(message)
+
+        start = time.perf_counter()
+        http_in_progress.inc()
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_progress.dec()
+            # route is known after routing, it's written to the same scope
+            route = route_name(scope)
+            http_duration.observe(time.perf_counter() - start, (scope['method'], route))
+            http_requests.inc((scope['method'], route, status))
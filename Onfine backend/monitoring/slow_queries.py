@@ -0,0 +1,129 @@
+import hashlib
+import json
+import re
+import threading
+from datetime import datetime, UTC
+from config import SLOW_QUERY_THRESHOLD, SLOW_QUERY_LOG, SLOW_QUERY_PARAMS
+from monitoring.metrics import route_name, statement_labels
+
+
+# statements with these operations get EXPLAIN QUERY PLAN, it doesn't run them
+EXPLAINED_OPERATIONS = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+# lists of IN (?, ?, ...) have other length in every request, but it's the same statement
+PLACEHOLDERS_PATTERN = re.compile(r'\?(?:\s*,\s*\?)+')
+SPACES_PATTERN = re.compile(r'\s+')
+MAX_PARAMETER_LENGTH = 200
+
+
+def statement_shape(statement: str) -> str:
+    return SPACES_PATTERN.sub(' ', PLACEHOLDERS_PATTERN.sub('?, ...', statement)).strip()
+
+def format_plan(rows) -> list[str]:
+    '''Rows of EXPLAIN QUERY PLAN (id, parent, notused, detail) as lines, nesting is shown by indent.'''
+
+    depth = { 0: -1 }
+    lines = []
+
+    for id_, parent, _, detail in rows:
+        depth[id_] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[id_] + detail)
+
+    return lines
+
+def truncate_parameter(value):
+    if isinstance(value, (str, bytes)) and len(value) > MAX_PARAMETER_LENGTH:
+        return f'{value[:MAX_PARAMETER_LENGTH]!s}... ({len(value)})'
+
+    return value
+
+
+class SlowQueryLog:
+    '''
+    Writes SQL statements which took `threshold` seconds or more to a file as JSON lines, with the route
+    they come from. The first time a statement shape is slow, its query plan is written too.
+    '''
+
+    def __init__(self, path: str, threshold: float, with_parameters: bool, max_shapes: int = 10_000):
+        self.path = path
+        self.threshold = threshold
+        self.with_parameters = with_parameters
+        self.max_shapes = max_shapes
+        # fingerprints of shapes which were explained already
+        self.explained: set[str] = set()
+        self.lock = threading.Lock()
+        self.file = None
+
+        self.logged = 0
+
+    def record(self, conn, statement: str, parameters, executemany: bool, duration: float):
+        shape = statement_shape(statement)
+        fingerprint = hashlib.sha1(shape.encode()).hexdigest()[:16]
+        operation, table = statement_labels(statement)
+        rows = None
+
+        if executemany:
+            rows = len(parameters)
+            parameters = parameters[0] if parameters else ()
+
+        with self.lock:
+            is_first = not fingerprint in self.explained and len(self.explained) < self.max_shapes
+
+            if is_first:
+                self.explained.add(fingerprint)
+
+        plan = None
+
+        if is_first and operation in EXPLAINED_OPERATIONS:
+            plan = self.explain(conn, statement, parameters)
+
+        entry = {
+            'time':        datetime.now(UTC).isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'route':       route_name(),
+            'operation':   operation,
+            'table':       table,
+            'fingerprint': fingerprint,
+            'statement':   shape,
+            'parameters':  self.format_parameters(parameters) if self.with_parameters else None,
+            'rows':        rows,
+            'plan':        plan,
+        }
+        self.write(json.dumps(entry, default=str))
+
+    def format_parameters(self, parameters):
+        # images and keys are long, they are not needed to reproduce the plan
+        if isinstance(parameters, dict):
+            return { name: truncate_parameter(value) for name, value in parameters.items() }
+
+        return [truncate_parameter(value) for value in parameters]
+
+    def explain(self, conn, statement: str, parameters) -> list[str]:
+        # on the same DBAPI connection, so the plan is made for the same schema and statistics
+        cursor = conn.connection.cursor()
+
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return format_plan(cursor.fetchall())
+        except Exception as error:
+            return [f'EXPLAIN failed: {error}']
+        finally:
+            cursor.close()
+
+    def write(self, line: str):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.logged += 1
+
+    def stats(self) -> dict:
+        return {
+            'threshold': self.threshold,
+            'logged':    self.logged,
+            'shapes':    len(self.explained),
+        }
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG, SLOW_QUERY_THRESHOLD / 1000, SLOW_QUERY_PARAMS)
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, Callable
+from fastapi import WebSocket
+from config import BROKER_BACKEND, BROKER_DB_PATH, BROKER_POLL_INTERVAL, BROKER_WORKER_TTL
+from tools import get_UUID
+from realtime.connections import ConnectionManager, manager
+
+
+logger = logging.getLogger(__name__)
+
+
+class Broker(ABC):
+    def __init__(self, manager: ConnectionManager):
+        # sockets which are held by this worker
+        self.manager = manager
+        # handlers of messages for workers itself (e.g. cache invalidation)
+        self.control_handlers: list[Callable[[str], None]] = []
+
+    async def start(self): pass
+
+    async def stop(self): pass
+
+    async def connect(self, user_id: str, socket: WebSocket, encoding: str = 'json'):
+        self.manager.connect(user_id, socket, encoding)
+
+    async def disconnect(self, user_id: str, socket: WebSocket):
+        self.manager.disconnect(user_id, socket)
+
+    @abstractmethod
+    async def publish(self, user_ids: Iterable[str], message: str): ...
+
+    @abstractmethod
+    async def broadcast(self, message: str): ...
+
+    @abstractmethod
+    def online_users(self, user_ids: Iterable[str]) -> set[str]: ...
+
+    def deliver(self, user_ids: Iterable[str], message: str):
+        self.manager.send(user_ids, message)
+
+    def on_control(self, handler: Callable[[str], None]):
+        self.control_handlers.append(handler)
+
+    def send_control(self, message: str):
+        # sync, so sync routes can call it too; handlers of this worker get it at once
+        self.handle_control(message)
+
+    def handle_control(self, message: str):
+        for handler in self.control_handlers:
+            handler(message)
+
+
+class LocalBroker(Broker):
+    async def publish(self, user_ids: Iterable[str], message: str):
+        self.deliver(user_ids, message)
+
+    async def broadcast(self, message: str):
+        self.deliver(self.manager.user_ids(), message)
+
+    def online_users(self, user_ids: Iterable[str]) -> set[str]:
+        return {id_ for id_ in user_ids if id_ in self.manager}
+
+
+class SQLiteBroker(Broker):
+    '''
+    Routes events between workers on one host through a shared SQLite file:
+    every worker registers its users in `clients` table and polls `events` addressed to it.
+    '''
+
+    # user_id of events which are addressed to workers, not to users
+    CONTROL = '#control'
+
+    def __init__(self, manager: ConnectionManager, path: str, poll_interval: float, worker_ttl: float):
+        super().__init__(manager)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.worker_ttl = worker_ttl
+        self.worker_id = get_UUID()
+        self.lock = threading.Lock()
+        self.conn: sqlite3.Connection | None = None
+        self.poll_task: asyncio.Task | None = None
+
+    async def start(self):
+        await asyncio.to_thread(self.__open)
+        self.poll_task = asyncio.create_task(self.__poll())
+
+    async def stop(self):
+        if self.poll_task:
+            self.poll_task.cancel()
+
+            try:
+                await self.poll_task
+            except asyncio.CancelledError:
+                pass
+
+        await asyncio.to_thread(self.__close)
+
+    async def connect(self, user_id: str, socket: WebSocket, encoding: str = 'json'):
+        await super().connect(user_id, socket, encoding)
+        await asyncio.to_thread(
+            self.__execute,
+            'INSERT OR IGNORE INTO clients (user_id, worker_id) VALUES (?, ?)',
+            (user_id, self.worker_id)
+        )
+
+    async def disconnect(self, user_id: str, socket: WebSocket):
+        await super().disconnect(user_id, socket)
+
+        if not user_id in self.manager:
+            await asyncio.to_thread(
+                self.__execute,
+                'DELETE FROM clients WHERE user_id = ? AND worker_id = ?',
+                (user_id, self.worker_id)
+            )
+
+    async def publish(self, user_ids: Iterable[str], message: str):
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return
+
+        self.deliver(user_ids, message)
+        await asyncio.to_thread(self.__send_remote, user_ids, message)
+
+    async def broadcast(self, message: str):
+        self.deliver(self.manager.user_ids(), message)
+        await asyncio.to_thread(self.__send_remote, None, message)
+
+    def send_control(self, message: str):
+        super().send_control(message)
+        self.__send_remote(None, message, control=True)
+
+    def online_users(self, user_ids: Iterable[str]) -> set[str]:
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        marks = ', '.join('?' * len(user_ids))
+
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT DISTINCT user_id FROM clients WHERE user_id IN ({marks})', user_ids
+            ).fetchall()
+
+        return {row[0] for row in rows}
+
+    def __open(self):
+        self.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS workers (
+                id        TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS clients (
+                user_id   TEXT NOT NULL,
+                worker_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, worker_id)
+            );
+            CREATE INDEX IF NOT EXISTS ix_clients_worker_id ON clients (worker_id);
+            CREATE TABLE IF NOT EXISTS events (
+                id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                worker_id TEXT NOT NULL,
+                user_id   TEXT,
+                message   TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_events_worker_id ON events (worker_id, id);
+        ''')
+        self.__heartbeat()
+
+    def __close(self):
+        if self.conn is None:
+            return
+
+        self.__remove_workers([self.worker_id])
+        self.conn.close()
+        self.conn = None
+
+    def __execute(self, sql: str, params: tuple = ()):
+        with self.lock:
+            self.conn.execute(sql, params)
+
+    def __send_remote(self, user_ids: list[str] | None, message: str, control: bool = False):
+        with self.lock:
+            if user_ids is None:
+                # message for all users (or for workers itself) at other workers
+                rows = self.conn.execute(
+                    'SELECT id, ? FROM workers WHERE id != ?', (self.CONTROL if control else None, self.worker_id)
+                ).fetchall()
+            else:
+                marks = ', '.join('?' * len(user_ids))
+                rows = self.conn.execute(
+                    f'SELECT worker_id, user_id FROM clients WHERE worker_id != ? AND user_id IN ({marks})',
+                    (self.worker_id, *user_ids)
+                ).fetchall()
+
+            if rows:
+                self.conn.executemany(
+                    'INSERT INTO events (worker_id, user_id, message) VALUES (?, ?, ?)',
+                    [(worker_id, user_id, message) for worker_id, user_id in rows]
+                )
+
+    def __fetch_events(self) -> list[tuple[str | None, str]]:
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, user_id, message FROM events WHERE worker_id = ? ORDER BY id LIMIT 500',
+                (self.worker_id,)
+            ).fetchall()
+
+            if rows:
+                self.conn.execute(
+                    'DELETE FROM events WHERE worker_id = ? AND id <= ?',
+                    (self.worker_id, rows[-1][0])
+                )
+
+        return [(user_id, message) for _, user_id, message in rows]
+
+    def __heartbeat(self):
+        now = time.time()
+
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO workers (id, heartbeat) VALUES (?, ?)',
+                (self.worker_id, now)
+            )
+            rows = self.conn.execute(
+                'SELECT id FROM workers WHERE heartbeat < ?', (now - self.worker_ttl,)
+            ).fetchall()
+
+        if rows:
+            self.__remove_workers([row[0] for row in rows])
+
+    def __remove_workers(self, worker_ids: list[str]):
+        marks = ', '.join('?' * len(worker_ids))
+
+        with self.lock:
+            self.conn.execute('BEGIN')
+
+            try:
+                self.conn.execute(f'DELETE FROM clients WHERE worker_id IN ({marks})', worker_ids)
+                self.conn.execute(f'DELETE FROM events WHERE worker_id IN ({marks})', worker_ids)
+                self.conn.execute(f'DELETE FROM workers WHERE id IN ({marks})', worker_ids)
+                self.conn.execute('COMMIT')
+            except Exception:
+                # otherwise the connection stays in the transaction and every next BEGIN fails
+                self.conn.execute('ROLLBACK')
+                raise
+
+    async def __poll(self):
+        last_heartbeat = time.monotonic()
+
+        # errors are logged and the loop goes on: if this task ends, the worker doesn't get
+        # events of other workers and stops sending heartbeats, so other workers prune it
+        while True:
+            events = []
+
+            try:
+                events = await asyncio.to_thread(self.__fetch_events)
+            except Exception:
+                logger.exception('Broker could not fetch events')
+
+            for user_id, message in events:
+                try:
+                    if user_id == self.CONTROL:
+                        self.handle_control(message)
+                    else:
+                        self.deliver(self.manager.user_ids() if user_id is None else [user_id], message)
+                except Exception:
+                    logger.exception('Broker could not handle an event')
+
+            if time.monotonic() - last_heartbeat > self.worker_ttl / 3:
+                try:
+                    await asyncio.to_thread(self.__heartbeat)
+                    last_heartbeat = time.monotonic()
+                except Exception:
+                    logger.exception('Broker could not send heartbeat')
+
+            if not events:
+                await asyncio.sleep(self.poll_interval)
+
+
+def create_broker() -> Broker:
+    if BROKER_BACKEND == 'sqlite':
+        return SQLiteBroker(manager, BROKER_DB_PATH, BROKER_POLL_INTERVAL, BROKER_WORKER_TTL)
+
+    if BROKER_BACKEND == 'local':
+        return LocalBroker(manager)
+
+    raise ValueError(f'Unknown broker backend: {BROKER_BACKEND}')
+
+
+broker = create_broker()
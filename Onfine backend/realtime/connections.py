@@ -0,0 +1,178 @@
+import asyncio
+import json
+import time
+from typing import Iterable
+from fastapi import WebSocket
+from config import WS_QUEUE_SIZE, WS_SLOW_POLICY, WS_SEND_TIMEOUT
+from monitoring.metrics import ws_fanout, ws_send_duration
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None # binary encoding is optional
+
+
+# encodings of events which clients can choose, events come from the broker as JSON
+ENCODINGS = ('json', 'msgpack') if msgpack else ('json',)
+
+def encode(message: str, encoding: str) -> str | bytes:
+    if encoding == 'msgpack':
+        return msgpack.packb(json.loads(message))
+
+    return message
+
+
+class Connection:
+    def __init__(self, user_id: str, socket: WebSocket, queue_size: int, encoding: str):
+        self.user_id = user_id
+        self.socket = socket
+        self.encoding = encoding
+        self.queue: asyncio.Queue[str | bytes] = asyncio.Queue(queue_size)
+        self.writer: asyncio.Task | None = None
+        self.dropped = 0
+        self.is_closing = False
+
+
+class ConnectionManager:
+    '''
+    Holds sockets of this worker. Every socket has a bounded outbound queue and its own
+    writer task, so sending never waits for a client and a slow client delays only itself.
+    '''
+
+    def __init__(self, queue_size: int, slow_policy: str, send_timeout: float):
+        if not slow_policy in ('drop', 'disconnect'):
+            raise ValueError(f'Unknown slow consumer policy: {slow_policy}')
+
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.send_timeout = send_timeout
+        self.connections: dict[str, Connection] = {}
+
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.connections
+
+    def user_ids(self) -> list[str]:
+        return list(self.connections)
+
+    def connect(self, user_id: str, socket: WebSocket, encoding: str = 'json') -> Connection:
+        if not encoding in ENCODINGS:
+            raise ValueError(f'Unknown encoding: {encoding}')
+
+        old = self.connections.get(user_id)
+
+        if old is not None:
+            self.__stop(old)
+
+        connection = Connection(user_id, socket, self.queue_size, encoding)
+        connection.writer = asyncio.create_task(self.__write(connection))
+        self.connections[user_id] = connection
+
+        return connection
+
+    def disconnect(self, user_id: str, socket: WebSocket) -> bool:
+        connection = self.connections.get(user_id)
+
+        # user could already reconnect with a new socket
+        if connection is None or connection.socket is not socket:
+            return False
+
+        self.connections.pop(user_id)
+        self.__stop(connection)
+        return True
+
+    def send(self, user_ids: Iterable[str], message: str):
+        # message is encoded once per encoding, not once per recipient
+        frames: dict[str, str | bytes] = { 'json': message }
+        queued = 0
+
+        for user_id in user_ids:
+            connection = self.connections.get(user_id)
+
+            if connection is None or connection.is_closing:
+                continue
+
+            frame = frames.get(connection.encoding)
+
+            if frame is None:
+                frame = frames[connection.encoding] = encode(message, connection.encoding)
+
+            try:
+                connection.queue.put_nowait(frame)
+                queued += 1
+            except asyncio.QueueFull:
+                self.__on_slow(connection)
+
+        ws_fanout.observe(queued)
+
+    def stats(self) -> dict:
+        depths = [conn.queue.qsize() for conn in self.connections.values()]
+        encodings = { encoding: 0 for encoding in ENCODINGS }
+
+        for conn in self.connections.values():
+            encodings[conn.encoding] += 1
+
+        return {
+            'connections':     len(depths),
+            'encodings':       encodings,
+            'queued':          sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'queue_size':      self.queue_size,
+            'slow_policy':     self.slow_policy,
+            'sent':            self.sent,
+            'dropped':         self.dropped,
+            'disconnected':    self.disconnected,
+        }
+
+    def __on_slow(self, connection: Connection):
+        if self.slow_policy == 'drop':
+            connection.dropped += 1
+            self.dropped += 1
+            return
+
+        self.disconnected += 1
+        self.__close(connection)
+
+    def __close(self, connection: Connection):
+        if connection.is_closing:
+            return
+
+        connection.is_closing = True
+        self.__stop(connection)
+        # socket handler receives disconnect and cleans up the user
+        asyncio.create_task(self.__close_socket(connection.socket))
+
+    def __stop(self, connection: Connection):
+        if connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    async def __close_socket(self, socket: WebSocket):
+        try:
+            await socket.close(code=1013)
+        except Exception:
+            pass
+
+    async def __write(self, connection: Connection):
+        while True:
+            message = await connection.queue.get()
+            send = connection.socket.send_bytes if isinstance(message, bytes) else connection.socket.send_text
+
+            start = time.perf_counter()
+
+            try:
+                await asyncio.wait_for(send(message), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.disconnected += 1
+                self.__close(connection)
+                return
+            except Exception:
+                return # socket is closed, its handler will disconnect it
+
+            self.sent += 1
+            ws_send_duration.observe(time.perf_counter() - start)
+
+
+manager = ConnectionManager(WS_QUEUE_SIZE, WS_SLOW_POLICY, WS_SEND_TIMEOUT)
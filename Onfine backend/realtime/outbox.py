@@ -0,0 +1,122 @@
+import asyncio
+import json
+from datetime import timedelta
+from typing import Iterable
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE
+from database.database import AsyncSessionMaker
+from database.models import OutboxEvent
+from realtime.broker import Broker, broker
+from tools import get_now_datetime
+
+
+def add_event(sess: Session | AsyncSession, user_ids: Iterable[str] | None, message: str):
+    '''Adds notification to the outbox in the transaction of `sess`, user_ids None means all users.'''
+
+    sess.add(OutboxEvent(
+        user_ids=None if user_ids is None else json.dumps(list(user_ids)),
+        message=message
+    ))
+
+
+class OutboxDispatcher:
+    '''
+    Sends events of `outbox` table through the broker. Events are committed together with
+    the change they describe, claimed by a dispatcher for `lease` seconds and deleted after sending,
+    so an event is delivered at least once even if a worker dies.
+    '''
+
+    def __init__(self, broker: Broker, batch_size: int, poll_interval: float, lease: float):
+        self.broker = broker
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease)
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+        self.sent = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        # send what is committed already, the rest is sent by other worker or after restart
+        try:
+            while await self.dispatch() == self.batch_size:
+                pass
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return { 'sent': self.sent }
+
+    def notify(self):
+        # called after commit, so events are sent without waiting for the next poll
+        self.wakeup.set()
+
+    async def dispatch(self) -> int:
+        now = get_now_datetime()
+
+        async with AsyncSessionMaker.begin() as sess:
+            ids = select(OutboxEvent.id).where(or_(
+                OutboxEvent.claimed_until == None,
+                OutboxEvent.claimed_until < now
+            )).order_by(OutboxEvent.id).limit(self.batch_size)
+
+            result = await sess.execute(update(OutboxEvent).where(
+                OutboxEvent.id.in_(ids.scalar_subquery())
+            ).values({
+                OutboxEvent.claimed_until: now + self.lease,
+                OutboxEvent.attempts:      OutboxEvent.attempts + 1,
+            }).returning(OutboxEvent.id, OutboxEvent.user_ids, OutboxEvent.message))
+
+            events = sorted(result.tuples())
+
+        if not events:
+            return 0
+
+        sent_ids = []
+
+        for id_, user_ids, message in events:
+            if user_ids is None:
+                await self.broker.broadcast(message)
+            else:
+                await self.broker.publish(json.loads(user_ids), message)
+
+            sent_ids.append(id_)
+
+        async with AsyncSessionMaker.begin() as sess:
+            await sess.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(sent_ids)))
+
+        self.sent += len(sent_ids)
+        return len(events)
+
+    async def __run(self):
+        while True:
+            self.wakeup.clear()
+
+            try:
+                count = await self.dispatch()
+            except Exception:
+                count = 0 # database is busy, events are sent at next time
+
+            if count == self.batch_size:
+                continue
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox = OutboxDispatcher(broker, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE)
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import Iterable
+from sqlalchemy import and_, select, update
+from sqlalchemy.orm import aliased
+import models.responses as resp
+from config import PRESENCE_GRACE, PRESENCE_FLUSH_INTERVAL, PRESENCE_CACHE_SIZE
+from database.database import AsyncSessionMaker
+from database.models import User, Chat, ChatUser, ChatTypes
+from database.profiles import invalidate_profiles_async
+from realtime.broker import Broker, broker
+from tools import LRUCache, get_now_datetime
+
+
+class ContactCache(LRUCache):
+    '''LRU cache of companions of direct chats (user id -> companion ids) of this worker.'''
+
+
+class PresenceService:
+    '''
+    Sends online/offline status of users of this worker to companions of their direct chats.
+    Disconnect is announced only if the user didn't come back during `grace` seconds, and changes
+    are sent in batches every `flush_interval` seconds, so reconnects of flaky clients cost nothing.
+    '''
+
+    def __init__(self, broker: Broker, contacts: ContactCache, grace: float, flush_interval: float):
+        self.broker = broker
+        self.contacts = contacts
+        self.grace = grace
+        self.flush_interval = flush_interval
+        # statuses which are waiting for flush
+        self.pending: dict[str, bool] = {}
+        # user id -> (time of disconnect, monotonic time when offline is announced)
+        self.leaving: dict[str, tuple] = {}
+        # user id -> time of disconnect, which is written to the database at flush
+        self.last_visits: dict[str, datetime] = {}
+        self.task: asyncio.Task | None = None
+
+        self.sent = 0
+        self.suppressed = 0
+
+    async def start(self):
+        self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        # server goes down, so users who are leaving don't come back to this worker
+        try:
+            await self.flush(force=True)
+        except Exception:
+            pass
+
+    def connect(self, user_id: str):
+        if self.leaving.pop(user_id, None) is not None:
+            # reconnect during the grace window, companions didn't see the user offline
+            self.suppressed += 1
+            return
+
+        self.pending[user_id] = True
+
+    def disconnect(self, user_id: str):
+        # user already has a new socket at this worker
+        if user_id in self.broker.manager:
+            return
+
+        if self.pending.get(user_id) is True:
+            # online status is not sent yet, so nothing is sent at all, but the visit is recorded
+            del self.pending[user_id]
+            self.last_visits[user_id] = get_now_datetime()
+            self.suppressed += 1
+            return
+
+        self.leaving[user_id] = (get_now_datetime(), time.monotonic() + self.grace)
+
+    def invalidate_contacts(self, user_ids: Iterable[str]):
+        '''Called after commit which created or deleted direct chats, at this and other workers.'''
+
+        user_ids = list(user_ids)
+
+        if user_ids:
+            self.broker.send_control(json.dumps({ 'type': 'contacts', 'user_ids': user_ids }))
+
+    async def invalidate_contacts_async(self, user_ids: Iterable[str]):
+        # broker can write to its database, so it doesn't run in the event loop
+        await asyncio.to_thread(self.invalidate_contacts, list(user_ids))
+
+    def handle_control(self, message: str):
+        data = json.loads(message)
+
+        if data.get('type') == 'contacts':
+            self.contacts.invalidate(data['user_ids'])
+
+    def stats(self) -> dict:
+        return {
+            'pending':     len(self.pending),
+            'leaving':     len(self.leaving),
+            'last_visits': len(self.last_visits),
+            'sent':        self.sent,
+            'suppressed':  self.suppressed,
+        }
+
+    async def flush(self, force: bool = False):
+        now = time.monotonic()
+
+        for user_id, (last_visit, until) in list(self.leaving.items()):
+            if force or until <= now:
+                del self.leaving[user_id]
+                self.pending[user_id] = False
+                self.last_visits[user_id] = last_visit
+
+        if self.pending:
+            statuses, self.pending = self.pending, {}
+
+            try:
+                await self.__send(statuses)
+            except Exception:
+                # they are sent at next flush, unless the user changed status again
+                for user_id, is_online in statuses.items():
+                    self.pending.setdefault(user_id, is_online)
+                raise
+
+        if self.last_visits:
+            last_visits, self.last_visits = self.last_visits, {}
+
+            try:
+                async with AsyncSessionMaker.begin() as sess:
+                    # bulk update by primary key
+                    await sess.execute(update(User), [
+                        { 'id': user_id, 'last_visit': last_visit } for user_id, last_visit in last_visits.items()
+                    ])
+            except Exception:
+                # they are written at next flush, a newer visit of the user wins
+                for user_id, last_visit in last_visits.items():
+                    self.last_visits.setdefault(user_id, last_visit)
+                raise
+
+            await invalidate_profiles_async(last_visits)
+
+    async def get_companions(self, user_ids: Iterable[str]) -> dict[str, list[str]]:
+        version = self.contacts.version
+        result = {}
+        missing = []
+
+        for user_id in user_ids:
+            companions = self.contacts.get(user_id)
+
+            if companions is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = companions
+
+        if not missing:
+            return result
+
+        chatUser1: ChatUser = aliased(ChatUser)
+        chatUser2: ChatUser = aliased(ChatUser)
+
+        query = select(chatUser1.user_id, chatUser2.user_id).select_from(Chat).where(
+            Chat.type == ChatTypes.chat.name
+        ).join(
+            chatUser1, and_(
+            chatUser1.chat_id == Chat.id,
+            chatUser1.user_id.in_(missing)
+        )).join(
+            chatUser2, and_(
+            chatUser2.chat_id == Chat.id,
+            chatUser2.user_id != chatUser1.user_id
+        ))
+        loaded: dict[str, list[str]] = { user_id: [] for user_id in missing }
+
+        async with AsyncSessionMaker() as sess:
+            for user_id, companion_id in (await sess.execute(query)).tuples():
+                loaded[user_id].append(companion_id)
+
+        for user_id, companions in loaded.items():
+            self.contacts.put(user_id, companions, version)
+
+        result.update(loaded)
+        return result
+
+    async def __send(self, statuses: dict[str, bool]):
+        offline = [user_id for user_id, is_online in statuses.items() if not is_online]
+
+        if offline:
+            # user can be still connected to other worker
+            for user_id in await asyncio.to_thread(self.broker.online_users, offline):
+                del statuses[user_id]
+
+        companions = await self.get_companions(statuses)
+
+        for user_id, is_online in statuses.items():
+            notifi = resp.NewStatus(user_id=user_id, is_online=is_online).model_dump_json()
+            await self.broker.publish(companions[user_id], notifi)
+
+        self.sent += len(statuses)
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception:
+                pass # database is busy, statuses are sent at next time
+
+
+presence = PresenceService(broker, ContactCache(PRESENCE_CACHE_SIZE), PRESENCE_GRACE, PRESENCE_FLUSH_INTERVAL)
+broker.on_control(presence.handle_control)
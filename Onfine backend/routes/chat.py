@@ -1,104 +1,143 @@
 from typing import Literal
 import json
-from fastapi import APIRouter, HTTPException, UploadFile, Form
+from fastapi import APIRouter, HTTPException, UploadFile, Form, Query, Request, Response
 import models.requests as reque
 import models.responses as resp
-from sqlalchemy import or_, and_, select, func
+from sqlalchemy import or_, and_, select, func, tuple_, true, union_all
+# route functions are named update and delete
+from sqlalchemy import update as sql_update, delete as sql_delete
 from sqlalchemy.orm import aliased
-from database.database import SessionMaker
-from database.models import User, Message, Chat, ChatUser, ChatTypes, Like
-from tools import connected_clients, check_auth, parse_model, get_UUID, get_now_datetime, save_image, remove_image, read_image
+from database.database import SessionMaker, AsyncSessionMaker
+from database.models import User, Message, Chat, ChatUser, ChatUnreadSender, ChatTypes, Like
+from database.search import search_chats
+from database.membership import get_chat, get_chat_sync, invalidate_chats, invalidate_chats_async
+from realtime.broker import broker
+from realtime.outbox import outbox, add_event
+from realtime.presence import presence
+from security.tokens import check_auth, check_auth_async
+from tools import parse_model, fast_response, make_etag, etag_matches, get_UUID, get_now_datetime, save_image, remove_image, read_image, image_url, encode_cursor, decode_cursor
 
 
 router = APIRouter()
 
 
+# each channel in posts is read separately by its history index, which is
+# limited by max count of compound SELECT in SQLite
+CHANNELS_PER_QUERY = 200
+
+
+def page_filter(data: reque.GetPosts, date_time_column, id_column):
+    if data.cursor:
+        cursor = decode_cursor(data.cursor)
+
+        if cursor is None:
+            raise HTTPException(400, 'Wrong cursor')
+
+        return tuple_(date_time_column, id_column) < cursor
+
+    if data.start_date_time:
+        return date_time_column < data.start_date_time
+
+    return true()
+
+def set_next_cursor(response: Response, rows: list, limit: int):
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers['X-Next-Cursor'] = encode_cursor(last.date_time, last.id)
+
+
 @router.post('/chat/posts', tags=['Chat'], response_model=list[resp.Post])
-def posts(data: reque.GetPosts):
+def posts(data: reque.GetPosts, response: Response):
     if not check_auth(data):
         raise HTTPException(401, 'Wrong token')
     
     with SessionMaker() as sess:
-        likes = sess.query(
-            Like.message_id,
-            func.count().label('likes_count')
-        ).group_by(Like.message_id).subquery()
-
-        rows = sess.query(
-            Chat.id,
-            Message.id,
-            Message.content,
-            Message.with_image,
-            Message.date_time,
-            likes.c.likes_count,
-            Like.user_id.label('is_liked')
-        ).join( # select channels by user subscribe
-            ChatUser, and_(
-            ChatUser.user_id == data.user_id,
-            ChatUser.chat_id == Chat.id,
+        query = select(ChatUser.chat_id).join(
+            Chat, and_(
+            Chat.id == ChatUser.chat_id,
             Chat.type == ChatTypes.channel.name,
-        )).join( # select messages from channels
-            Message, and_(
-            Message.chat_id == Chat.id,
-            Message.date_time < data.start_date_time,
-        )).outerjoin( # find like at user on finded messages
-            Like, and_(
-            Like.message_id == Message.id,
-            Like.user_id == data.user_id,
-        )).outerjoin( # join likes on messages
-            likes,
-            likes.c.message_id == Message.id
-        ).order_by(Message.date_time.desc()).limit(data.limit).all()
+        )).where(ChatUser.user_id == data.user_id)
+        channel_ids: list[str] = sess.execute(query).scalars().all()
+
+        rows = []
+
+        for i in range(0, len(channel_ids), CHANNELS_PER_QUERY):
+            # latest posts of every channel, merged into one page
+            pages = [
+                select(
+                    Message.chat_id,
+                    Message.id,
+                    Message.content,
+                    Message.with_image,
+                    Message.date_time,
+                    Message.likes_count,
+                ).where(
+                    Message.chat_id == chat_id,
+                    page_filter(data, Message.date_time, Message.id)
+                ).order_by(
+                    Message.date_time.desc(),
+                    Message.id.desc()
+                ).limit(data.limit).subquery().select()
+                for chat_id in channel_ids[i:i + CHANNELS_PER_QUERY]
+            ]
+            page = union_all(*pages).subquery()
+
+            rows += sess.query(
+                page.c.chat_id,
+                page.c.id,
+                page.c.content,
+                page.c.with_image,
+                page.c.date_time,
+                page.c.likes_count,
+                Like.user_id.label('is_liked')
+            ).outerjoin( # find like at user on finded messages
+                Like, and_(
+                Like.message_id == page.c.id,
+                Like.user_id == data.user_id,
+            )).order_by(
+                page.c.date_time.desc(),
+                page.c.id.desc()
+            ).limit(data.limit).all()
+
+    rows.sort(key=lambda row: (row.date_time, row.id), reverse=True)
+    rows = rows[:data.limit]
+    set_next_cursor(response, rows, data.limit)
 
     posts = []
 
+    # rows are written straight to JSON, fields are the same as in resp.Post
     for row in rows:
         chat_id, id_, content, with_image, date_time, likes, is_liked = row.tuple()
 
-        posts.append(resp.Post(
-            id=id_,
-            sender_id=chat_id,
-            content=content,
-            image=read_image(f'{id_}_msg_image') if with_image else None,
-            date_time=date_time,
-            likes=0 if likes is None else likes,
-            is_liked=not is_liked is None
-        ))
+        posts.append({
+            'id':        id_,
+            'sender_id': chat_id,
+            'content':   content,
+            'image':     read_image(f'{id_}_msg_image') if with_image and data.inline_images else None,
+            'image_url': image_url(id_) if with_image and not data.inline_images else None,
+            'date_time': date_time,
+            'likes':     likes,
+            'is_liked':  not is_liked is None,
+        })
     
-    return posts
+    return fast_response(posts, response.headers)
 
 
 @router.post('/chat/messages', tags=['Chat'], response_model=list[resp.Message])
-def messages(data: reque.GetMessages):
+def messages(data: reque.GetMessages, response: Response):
     if not check_auth(data):
         raise HTTPException(401, 'Wrong token')
 
     with SessionMaker() as sess:
-        row = sess.query(
-            Chat.id,
-            ChatUser.user_id
-        ).filter(
-            Chat.id == data.chat_id
-        ).outerjoin(
-            ChatUser, and_(
-            ChatUser.chat_id == Chat.id,
-            ChatUser.user_id == data.user_id
-        )).first()
+        chat = get_chat_sync(sess, data.chat_id)
 
-        if row is None:
+        if chat is None:
             raise HTTPException(404, 'Chat with this ID not exists')
 
-        _, user_id = row.tuple()
-
-        if user_id is None:
+        if chat.is_admin(data.user_id) is None:
             raise HTTPException(403, 'You are not a member of this chat')
 
 
-        likes = sess.query(
-            Like.message_id,
-            func.count().label('likes_count')
-        ).group_by(Like.message_id).subquery()
-
         messages = sess.query(
             Message.id,
             Message.sender_id,
@@ -106,11 +145,15 @@ def messages(data: reque.GetMessages):
             Message.with_image,
             Message.date_time,
             Message.reply_content,
-            Message.reply_sender_id
+            Message.reply_sender_id,
+            Message.likes_count
         ).filter(
             Message.chat_id == data.chat_id,
-            Message.date_time < data.start_date_time
-        ).order_by(Message.date_time.desc()).limit(data.limit).subquery()
+            page_filter(data, Message.date_time, Message.id)
+        ).order_by(
+            Message.date_time.desc(),
+            Message.id.desc()
+        ).limit(data.limit).subquery()
 
         rows = sess.query(
             messages.c.id,
@@ -120,35 +163,39 @@ def messages(data: reque.GetMessages):
             messages.c.date_time,
             messages.c.reply_content,
             messages.c.reply_sender_id,
-            likes.c.likes_count,
+            messages.c.likes_count,
             Like.user_id.label('is_liked')
         ).outerjoin(
             Like, and_(
             Like.message_id == messages.c.id,
             Like.user_id == data.user_id
-        )).outerjoin(
-            likes,
-            likes.c.message_id == messages.c.id
+        )).order_by(
+            messages.c.date_time.desc(),
+            messages.c.id.desc()
         ).all()
 
+    set_next_cursor(response, rows, data.limit)
+
     messages = []
 
+    # rows are written straight to JSON, fields are the same as in resp.Message
     for row in rows:
         id_, sender_id, content, with_image, date_time, reply_content, reply_sender_id, likes, is_liked = row.tuple()
 
-        messages.append(resp.Message(
-            id=id_,
-            sender_id=sender_id,
-            content=content,
-            image=read_image(f'{id_}_msg_image') if with_image else None,
-            date_time=date_time,
-            reply_content=reply_content,
-            reply_sender_id=reply_sender_id,
-            likes=0 if likes is None else likes,
-            is_liked=not is_liked is None
-        ))
+        messages.append({
+            'id':              id_,
+            'sender_id':       sender_id,
+            'content':         content,
+            'image':           read_image(f'{id_}_msg_image') if with_image and data.inline_images else None,
+            'image_url':       image_url(id_) if with_image and not data.inline_images else None,
+            'date_time':       date_time,
+            'likes':           likes,
+            'is_liked':        not is_liked is None,
+            'reply_content':   reply_content,
+            'reply_sender_id': reply_sender_id,
+        })
     
-    return messages
+    return fast_response(messages, response.headers)
 
 
 @router.post('/chat/all', tags=['Chat'], response_model=list[resp.Chat])
@@ -157,17 +204,7 @@ def all_chats(data: reque.Auth):
         raise HTTPException(401, 'Wrong token')
 
     with SessionMaker() as sess:
-        last_messages = sess.query(
-            Message.chat_id,
-            func.max(Message.date_time).label('date_time')
-        ).group_by(Message.chat_id).subquery()
-        
-        chatUsers = sess.query(
-            ChatUser.chat_id,
-            ChatUser.is_admin,
-            ChatUser.key,
-            ChatUser.unread_count
-        ).filter(ChatUser.user_id == data.user_id).subquery()
+        companion: ChatUser = aliased(ChatUser)
 
         rows = sess.query(
             Chat.id,
@@ -178,54 +215,52 @@ def all_chats(data: reque.Auth):
             Chat.is_private,
             Chat.members_count,
             Chat.last_reading,
-            Message.content,
-            Message.date_time,
-            Message.sender_id,
-            chatUsers.c.is_admin,
-            chatUsers.c.key,
-            chatUsers.c.unread_count,
-            ChatUser.user_id
-        ).select_from(chatUsers).outerjoin(
+            Chat.last_message_content,
+            Chat.last_message_datetime,
+            Chat.last_message_sender_id,
+            ChatUser.is_admin,
+            ChatUser.key,
+            ChatUser.unread_count,
+            companion.user_id
+        ).select_from(ChatUser).join(
             Chat,
-            Chat.id == chatUsers.c.chat_id
-        ).outerjoin(
-            last_messages,
-            last_messages.c.chat_id == Chat.id
+            Chat.id == ChatUser.chat_id
         ).outerjoin(
-            Message, and_(
-            Message.chat_id == last_messages.c.chat_id,
-            Message.date_time == last_messages.c.date_time
-        )).outerjoin(
-            ChatUser, and_(
+            companion, and_(
             Chat.type == ChatTypes.chat.name,
-            ChatUser.chat_id == Chat.id,
-            ChatUser.user_id != data.user_id
-        )).order_by(Message.date_time.desc()).all()
+            companion.chat_id == Chat.id,
+            companion.user_id != data.user_id
+        )).filter(
+            ChatUser.user_id == data.user_id
+        ).order_by(Chat.last_message_datetime.desc()).all()
 
     chats = []
 
+    # rows are written straight to JSON, fields are the same as in resp.Chat
     for row in rows:
         id_, type_, name, description, with_icon, is_private, members_count, last_reading, msg_content, msg_datetime, msg_sender_id, is_admin, key, unread_count, companion_id = row.tuple()
 
-        chats.append(resp.Chat(
-            id=id_,
-            type=type_,
-            companion_id=companion_id,
-            name=name,
-            description=description,
-            with_icon=with_icon,
-            is_private=is_private,
-            members_count=members_count,
-            last_reading=last_reading,
-            message_content=msg_content,
-            message_datetime=msg_datetime,
-            message_sender_id=msg_sender_id,
-            is_admin=is_admin,
-            key=key,
-            unread_count=unread_count
-        ))
+        chats.append({
+            'id':                     id_,
+            'type':                   type_,
+            'name':                   name,
+            'description':            description,
+            'with_icon':              with_icon,
+            'members_count':          members_count,
+            'key':                    key,
+            'companion_id':           companion_id,
+            'is_private':             is_private,
+            'last_reading':           last_reading,
+            'message_content':        msg_content,
+            'message_datetime':       msg_datetime,
+            'message_sender_id':      msg_sender_id,
+            'is_admin':               is_admin,
+            'unread_count':           unread_count,
+            'writing_users':          [],
+            'all_messages_is_loaded': False,
+        })
     
-    return chats
+    return fast_response(chats)
 
 
 @router.post('/chat/create', tags=['Chat'], response_model=resp.CreatedChat)
@@ -234,7 +269,7 @@ async def create(data: str = Form(...), icon: UploadFile | Literal['none'] = For
     if not data:
         raise HTTPException(400, 'Wrong parameters')
 
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
     
     # Validation
@@ -242,13 +277,14 @@ async def create(data: str = Form(...), icon: UploadFile | Literal['none'] = For
     if data.type == ChatTypes.chat.name and len(data.members) != 1:
         raise HTTPException(400, 'This chat should have one member')
     
-    with SessionMaker.begin() as sess:
+    async with AsyncSessionMaker.begin() as sess:
         member_ids = [member.id for member in data.members]
 
         if data.user_id in member_ids:
             raise HTTPException(400, "You can't identify yourself as a member")
 
-        members_count: int = sess.query(func.count()).filter(User.id.in_(member_ids)).scalar()
+        query = select(func.count()).select_from(User).where(User.id.in_(member_ids))
+        members_count: int = (await sess.execute(query)).scalar()
 
         if members_count < len(data.members):
             raise HTTPException(404, 'Not all members were found')
@@ -257,7 +293,7 @@ async def create(data: str = Form(...), icon: UploadFile | Literal['none'] = For
             chatUser1: ChatUser = aliased(ChatUser)
             chatUser2: ChatUser = aliased(ChatUser)
 
-            chat_id: str | None = sess.query(Chat.id).filter(
+            query = select(Chat.id).where(
                 Chat.type == ChatTypes.chat.name
             ).join(
                 chatUser1, and_(
@@ -267,7 +303,8 @@ async def create(data: str = Form(...), icon: UploadFile | Literal['none'] = For
                 chatUser2, and_(
                 chatUser2.chat_id == Chat.id,
                 chatUser2.user_id == data.members[0].id
-            )).scalar()
+            ))
+            chat_id: str | None = (await sess.execute(query)).scalar()
 
             if not chat_id is None:
                 raise HTTPException(400, 'This chat already exists')
@@ -321,28 +358,32 @@ async def create(data: str = Form(...), icon: UploadFile | Literal['none'] = For
                 key=member.key
             ))
     
-    # Notification
+        # Notification
 
-    chat = resp.Chat(
-        id=id_,
-        type=data.type,
-        name=name,
-        description=description,
-        with_icon=with_icon,
-        companion_id=companion_id,
-        is_private=is_private,
-        members_count=members_count,
-        is_admin=False,
-        last_reading=last_reading
-    )
+        chat = resp.Chat(
+            id=id_,
+            type=data.type,
+            name=name,
+            description=description,
+            with_icon=with_icon,
+            companion_id=companion_id,
+            is_private=is_private,
+            members_count=members_count,
+            is_admin=False,
+            last_reading=last_reading
+        )
 
-    for member in data.members:
-        if member.id in connected_clients:
+        for member in data.members:
             chat.key = member.key
             chat.is_admin = member.is_admin
-            
+
             notifi = resp.NewChat(chat=chat).model_dump_json()
-            await connected_clients[member.id].send_text(notifi)
+            add_event(sess, [member.id], notifi)
+
+    if data.type == ChatTypes.chat.name:
+        await presence.invalidate_contacts_async([data.user_id, data.members[0].id])
+
+    outbox.notify()
     
     return resp.CreatedChat(chat_id=id_)
 
@@ -353,11 +394,12 @@ async def update(data: str = Form(...), icon: UploadFile | Literal['none', 'null
     if not data:
         raise HTTPException(400, 'Wrong parameters')
     
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
     
-    with SessionMaker.begin() as sess:
-        id_: str | None = sess.query(Chat.id).filter(Chat.id == data.chat_id).scalar()
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(Chat.id).where(Chat.id == data.chat_id)
+        id_: str | None = (await sess.execute(query)).scalar()
 
         if id_ is None:
             raise HTTPException(404, 'Chat with this ID not exists')
@@ -378,78 +420,89 @@ async def update(data: str = Form(...), icon: UploadFile | Literal['none', 'null
                 values[Chat.with_icon] = True
         
 
-        sess.query(Chat).filter(Chat.id == data.chat_id).update(values)
+        await sess.execute(sql_update(Chat).where(Chat.id == data.chat_id).values(values))
 
 
 @router.post('/chat/read', tags=['Chat'])
 async def read(data: reque.ChatData):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
     
-    with SessionMaker.begin() as sess:
-        unread_senders: str | None = sess.query(Chat.unread_senders).filter(Chat.id == data.chat_id).scalar()
+    async with AsyncSessionMaker() as sess:
+        chat = await get_chat(sess, data.chat_id)
 
-        if unread_senders is None:
-            raise HTTPException(404, 'Chat with this ID not exists')
+    if chat is None:
+        raise HTTPException(404, 'Chat with this ID not exists')
 
-        change_count = sess.query(ChatUser).filter(
+    if chat.is_admin(data.user_id) is None:
+        raise HTTPException(403, 'You are not a member of this chat')
+
+    async with AsyncSessionMaker.begin() as sess:
+        result = await sess.execute(sql_update(ChatUser).where(
             ChatUser.chat_id == data.chat_id,
             ChatUser.user_id == data.user_id
-        ).update({ ChatUser.unread_count: 0 })
+        ).values({ ChatUser.unread_count: 0 }))
 
-        if change_count == 0:
+        # the user could leave the chat after the check
+        if result.rowcount == 0:
             raise HTTPException(403, 'You are not a member of this chat')
 
-        if unread_senders != '':
+        result = await sess.execute(
+            sql_delete(ChatUnreadSender).where(ChatUnreadSender.chat_id == data.chat_id).returning(ChatUnreadSender.user_id)
+        )
+        sender_ids: list[str] = result.scalars().all()
+
+        if sender_ids:
             last_reading = get_now_datetime()
 
-            sess.query(Chat).filter(Chat.id == data.chat_id).update({
-                Chat.unread_senders: '',
+            await sess.execute(sql_update(Chat).where(Chat.id == data.chat_id).values({
                 Chat.last_reading: last_reading
-            })
+            }))
 
             notify = resp.ReadedMessages(
                 chat_id=data.chat_id,
                 last_reading=last_reading
             ).model_dump_json()
 
-            for sender_id in unread_senders.split(';'):
-                if sender_id in connected_clients:
-                    await connected_clients[sender_id].send_text(notify)
+            add_event(sess, sender_ids, notify)
+
+    outbox.notify()
 
 
 @router.post('/chat/chat_users', tags=['Chat'], response_model=list[str])
-def chat_users(data: reque.ChatData):
+def chat_users(data: reque.ChatData, request: Request):
     if not check_auth(data):
         raise HTTPException(401, 'Wrong token')
     
     with SessionMaker() as sess:
-        user_id: str | None = sess.query(ChatUser.chat_id).filter(
-            ChatUser.chat_id == data.chat_id,
-            ChatUser.user_id == data.user_id
-        ).scalar()
+        chat = get_chat_sync(sess, data.chat_id)
 
-        if user_id is None:
-            raise HTTPException(403, 'You are not a member of this chat')
+    if chat is None or chat.is_admin(data.user_id) is None:
+        raise HTTPException(403, 'You are not a member of this chat')
 
-        query = select(ChatUser.user_id).where(ChatUser.chat_id == data.chat_id, ChatUser.user_id != user_id)
-        user_ids: list[str] = sess.execute(query).scalars().all()
-        
-        return user_ids
+    user_ids = chat.others(data.user_id)
+    etag = make_etag(*sorted(user_ids))
+    headers = { 'ETag': etag, 'Cache-Control': 'private, no-cache' }
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    return fast_response(user_ids, headers)
 
 
 @router.post('/chat/add_members', tags=['Chat'])
 async def add_members(data: reque.AddMembers):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
 
     if not data.members:
         raise HTTPException(400, 'Members not specified')
     
-    with SessionMaker.begin() as sess:
+    async with AsyncSessionMaker.begin() as sess:
         # check chat
 
-        chat_type: str | None = sess.query(Chat.type).filter(Chat.id == data.chat_id).scalar()
+        query = select(Chat.type).where(Chat.id == data.chat_id)
+        chat_type: str | None = (await sess.execute(query)).scalar()
 
         if chat_type is None:
             raise HTTPException(404, 'Chat with this ID not exists')
@@ -464,20 +517,22 @@ async def add_members(data: reque.AddMembers):
         if data.user_id in member_ids:
             raise HTTPException(400, "You can't identify yourself as a member")
 
-        members_count: int = sess.query(func.count()).filter(User.id.in_(member_ids)).scalar()
+        query = select(func.count()).select_from(User).where(User.id.in_(member_ids))
+        members_count: int = (await sess.execute(query)).scalar()
 
         if members_count < len(member_ids):
             raise HTTPException(404, 'Member with this ID not exists')
 
 
-        rows = sess.query(
+        query = select(
             ChatUser.user_id,
             ChatUser.is_admin
-        ).filter(
+        ).where(
             ChatUser.chat_id == data.chat_id, or_(
                 ChatUser.user_id == data.user_id,
                 ChatUser.user_id.in_(member_ids)
-        )).all()
+        ))
+        rows = (await sess.execute(query)).all()
 
         is_admin = None
 
@@ -507,74 +562,64 @@ async def add_members(data: reque.AddMembers):
                 key=member.key
             ))
 
-        sess.query(Chat).filter(Chat.id == data.chat_id).update({
+        await sess.execute(sql_update(Chat).where(Chat.id == data.chat_id).values({
             Chat.members_count: Chat.members_count + members_count
-        })
+        }))
 
-        last_message = sess.query(
-            Message.chat_id,
-            Message.content,
-            Message.date_time,
-            Message.sender_id,
-        ).filter(
-            Message.chat_id == data.chat_id
-        ).order_by(Message.date_time.desc()).limit(1).subquery()
-
-        row = sess.query(
+        query = select(
             Chat.name,
             Chat.description,
             Chat.with_icon,
             Chat.is_private,
             Chat.last_reading,
             Chat.members_count,
-            last_message.c.content,
-            last_message.c.date_time,
-            last_message.c.sender_id,
-        ).filter(
-            Chat.id == data.chat_id
-        ).outerjoin(
-            last_message,
-            last_message.c.chat_id == Chat.id
-        ).first()
+            Chat.last_message_content,
+            Chat.last_message_datetime,
+            Chat.last_message_sender_id,
+        ).where(Chat.id == data.chat_id)
+        row = (await sess.execute(query)).first()
 
         name, description, with_icon, is_private, last_reading, members_count, msg_content, msg_datetime, msg_sender_id = row.tuple()
     
-    # Notify other users at chat
+        # Notify other users at chat
 
-    chat = resp.Chat(
-        id=data.chat_id,
-        type=chat_type,
-        name=name,
-        description=description,
-        with_icon=with_icon,
-        is_private=is_private,
-        last_reading=last_reading,
-        members_count=members_count,
-        message_content=msg_content,
-        message_datetime=msg_datetime,
-        message_sender_id=msg_sender_id,
-        is_admin=False
-    )
+        chat = resp.Chat(
+            id=data.chat_id,
+            type=chat_type,
+            name=name,
+            description=description,
+            with_icon=with_icon,
+            is_private=is_private,
+            last_reading=last_reading,
+            members_count=members_count,
+            message_content=msg_content,
+            message_datetime=msg_datetime,
+            message_sender_id=msg_sender_id,
+            is_admin=False
+        )
 
-    for member in data.members:
-        if member.id in connected_clients:
+        for member in data.members:
             chat.key = member.key
             chat.is_admin = member.is_admin
-            
+
             notify = resp.NewChat(chat=chat).model_dump_json()
-            await connected_clients[member.id].send_text(notify)
+            add_event(sess, [member.id], notify)
+
+    await invalidate_chats_async([data.chat_id])
+    outbox.notify()
 
 
 @router.delete('/chat/remove_members', tags=['Chat'])
 async def remove_members(data: reque.RemoveMembers):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
     
-    with SessionMaker.begin() as sess:
-        is_admin: bool | None = sess.query(ChatUser.is_admin).filter(
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(ChatUser.is_admin).where(
             ChatUser.user_id == data.user_id,
             ChatUser.chat_id == data.chat_id
-        ).scalar()
+        )
+        is_admin: bool | None = (await sess.execute(query)).scalar()
 
         if is_admin is None:
             raise HTTPException(403, 'You are not a member of this chat')
@@ -582,18 +627,21 @@ async def remove_members(data: reque.RemoveMembers):
         if not is_admin:
             raise HTTPException(403, 'You are not a admin of this chat')
         
-        members_count: int = sess.query(func.count()).filter(
+        query = select(func.count()).select_from(ChatUser).where(
             ChatUser.chat_id == data.chat_id,
             ChatUser.user_id.in_(data.member_ids)
-        ).scalar()
+        )
+        members_count: int = (await sess.execute(query)).scalar()
 
         if members_count < len(data.member_ids):
             raise HTTPException(400, 'User with this ID is not a member of this chat')
         
-        sess.query(ChatUser).filter(
+        await sess.execute(sql_delete(ChatUser).where(
             ChatUser.chat_id == data.chat_id,
             ChatUser.user_id.in_(data.member_ids)
-        ).delete()
+        ))
+
+    await invalidate_chats_async([data.chat_id])
 
 
 @router.post('/chat/join', tags=['Chat'], response_model=resp.Chat)
@@ -638,30 +686,18 @@ def join(data: reque.ChatData):
         })
 
 
-        last_message = sess.query(
-            Message.chat_id,
-            Message.content,
-            Message.date_time,
-            Message.sender_id
-        ).filter(
-            Message.chat_id == data.chat_id
-        ).order_by(Message.date_time.desc()).limit(1).subquery()
-
         row = sess.query(
             Chat.name,
             Chat.description,
             Chat.with_icon,
             Chat.last_reading,
             Chat.members_count,
-            last_message.c.content,
-            last_message.c.date_time,
-            last_message.c.sender_id,
-        ).filter(
-            Chat.id == data.chat_id
-        ).outerjoin(
-            last_message,
-            last_message.c.chat_id == Chat.id,
-        ).first()
+            Chat.last_message_content,
+            Chat.last_message_datetime,
+            Chat.last_message_sender_id,
+        ).filter(Chat.id == data.chat_id).first()
+
+    invalidate_chats([data.chat_id])
     
     name, description, with_icon, last_reading, members_count, msg_content, msg_datetime, msg_sender_id = row.tuple()
 
@@ -712,28 +748,31 @@ def leave(data: reque.ChatData):
                 Chat.members_count: members_count - 1
             })
 
+    invalidate_chats([data.chat_id])
+
 
 @router.delete('/chat/delete', tags=['Chat'])
 async def delete(data: reque.ChatData):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
 
-    with SessionMaker.begin() as sess:
-        row = sess.query(
-            Chat.id,
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(
+            Chat.type,
             ChatUser.is_admin
-        ).filter(
+        ).where(
             Chat.id == data.chat_id
         ).outerjoin(
             ChatUser, and_(
             ChatUser.chat_id == Chat.id,
             ChatUser.user_id == data.user_id
-        )).first()
+        ))
+        row = (await sess.execute(query)).first()
 
         if row is None:
             raise HTTPException(404, 'Chat with this ID not exists')
         
-        _, is_admin = row.tuple()
+        chat_type, is_admin = row.tuple()
 
         if is_admin is None:
             raise HTTPException(403, 'You are not a member of this chat')
@@ -742,32 +781,29 @@ async def delete(data: reque.ChatData):
             raise HTTPException(403, 'You are not an admin of this chat')
         
         query = select(ChatUser.user_id).where(ChatUser.chat_id == data.chat_id, ChatUser.user_id != data.user_id)
-        user_ids: list[str] = sess.execute(query).scalars().all()
+        user_ids: list[str] = (await sess.execute(query)).scalars().all()
 
-        sess.query(Chat).filter(Chat.id == data.chat_id).delete()
-        
-    remove_image(f'{data.chat_id}_icon')
+        await sess.execute(sql_delete(Chat).where(Chat.id == data.chat_id))
 
-    notifi = resp.DeletedChat(chat_id=data.chat_id).model_dump_json()
+        notifi = resp.DeletedChat(chat_id=data.chat_id).model_dump_json()
+        add_event(sess, user_ids, notifi)
 
-    for user_id in user_ids:
-        if user_id in connected_clients:
-            await connected_clients[user_id].send_text(notifi)
+    await invalidate_chats_async([data.chat_id])
+
+    if chat_type == ChatTypes.chat.name:
+        await presence.invalidate_contacts_async([data.user_id, *user_ids])
+
+    outbox.notify()
+    remove_image(f'{data.chat_id}_icon')
 
 
 @router.post('/chat/writing', tags=['Chat'])
 async def writing(data: reque.WritingInChat):
-    with SessionMaker() as sess:
-        user_id: str | None = sess.query(ChatUser.user_id).filter(
-            ChatUser.chat_id == data.chat_id,
-            ChatUser.user_id == data.user_id
-        ).scalar()
+    async with AsyncSessionMaker() as sess:
+        chat = await get_chat(sess, data.chat_id)
 
-        if user_id is None:
-            raise HTTPException(403, 'You are not a member of this chat')
-
-        query = select(ChatUser.user_id).where(ChatUser.chat_id == data.chat_id, ChatUser.user_id != data.user_id)
-        user_ids = sess.execute(query).scalars().all()
+    if chat is None or chat.is_admin(data.user_id) is None:
+        raise HTTPException(403, 'You are not a member of this chat')
 
     notifi = resp.NewWriting(
         is_writing=data.is_writing,
@@ -775,13 +811,17 @@ async def writing(data: reque.WritingInChat):
         chat_id=data.chat_id
     ).model_dump_json()
 
-    for user_id in user_ids:
-        if user_id in connected_clients:
-            await connected_clients[user_id].send_text(notifi)
+    # typing status is short-lived and nothing is written, so it goes past the outbox
+    await broker.publish(chat.others(data.user_id), notifi)
 
 
 @router.get('/chat/search', tags=['Chat'], response_model=list[resp.ChatBaseData])
-def search(value: str, chat_type: str | None = None):
+def search(
+    value: str = Query(min_length=1, max_length=50),
+    chat_type: str | None = None,
+    limit: int = Query(ge=1, le=50, default=20),
+    offset: int = Query(ge=0, le=1000, default=0)
+):
     with SessionMaker() as sess:
         query = sess.query(
             Chat.id,
@@ -791,13 +831,13 @@ def search(value: str, chat_type: str | None = None):
             Chat.with_icon,
             Chat.members_count,
         ).filter(
-            Chat.name.icontains(value),
             Chat.is_private == False
         )
         if chat_type:
             query = query.filter(Chat.type == chat_type)
-        
-        rows = query.all()
+
+        query = search_chats(query, value)
+        rows = query.limit(limit).offset(offset).all()
         chats = []
 
         for row in rows:
@@ -1,18 +1,27 @@
-from fastapi import APIRouter, HTTPException
+import re
+from fastapi import APIRouter, HTTPException, Request, Response
 import models.requests as reque
 import models.responses as resp
-from sqlalchemy import and_, select
-from database.database import SessionMaker
-from database.models import Message, User, Chat, ChatUser, ChatTypes, Like
-from tools import connected_clients, check_auth, get_UUID, get_now_datetime, save_image, remove_image
+from sqlalchemy import and_, select, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+# route function is named delete
+from sqlalchemy import update as sql_update, delete as sql_delete
+from database.database import AsyncSessionMaker
+from database.models import Message, User, Chat, ChatUser, ChatUnreadSender, ChatTypes, Like
+from database.membership import get_chats, get_chat
+from realtime.outbox import outbox, add_event
+from security.tokens import check_auth_async
+from tools import get_UUID, get_now_datetime, save_image, remove_image, read_image, image_etag, etag_matches
 
 
 router = APIRouter()
 
+UUID_RE = re.compile(r'[0-9a-f]{32}')
+
 
 @router.post('/message/send', tags=['Message'], response_model=resp.SentMessage)
 async def send(data: reque.SendMessages):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
 
     # Validation
@@ -22,185 +31,197 @@ async def send(data: reque.SendMessages):
 
     chat_ids = [msg.chat_id for msg in data.messages]
 
-    with SessionMaker.begin() as sess:
-        rows = sess.query(
-            Chat.type,
-            ChatUser.is_admin
-        ).filter(
-            Chat.id.in_(chat_ids)
-        ).outerjoin(
-            ChatUser, and_(
-            ChatUser.chat_id == Chat.id,
-            ChatUser.user_id == data.user_id
-        )).all()
+    # a message per chat, ids of messages are returned by chat id
+    if len(set(chat_ids)) != len(chat_ids):
+        raise HTTPException(400, 'Several messages to the same chat')
 
+    async with AsyncSessionMaker() as sess:
+        chats = await get_chats(sess, chat_ids)
 
-        if len(rows) < len(chat_ids):
-            raise HTTPException(404, 'Chat with this ID not exists')
+        for chat_id in chat_ids:
+            chat = chats.get(chat_id)
 
-        for row in rows:
-            chat_type, is_admin = row.tuple()
+            if chat is None:
+                raise HTTPException(404, 'Chat with this ID not exists')
+
+            is_admin = chat.is_admin(data.user_id)
 
             if is_admin is None:
                 raise HTTPException(403, 'You are not a member of this chat')
 
-            if chat_type == ChatTypes.channel.name and not is_admin:
+            if chat.type == ChatTypes.channel.name and not is_admin:
                 raise HTTPException(403, 'You are not an admin of this chat')
 
         if not data.reply_sender_id is None:
-            user_id: str | None = sess.query(User.id).filter(User.id == data.reply_sender_id).scalar()
+            query = select(User.id).where(User.id == data.reply_sender_id)
+            user_id: str | None = (await sess.execute(query)).scalar()
 
             if user_id is None:
                 raise HTTPException(404, 'User with this ID not exists')
 
-        # Prepare data
+    recipients = { chat_id: chat.others(data.user_id) for chat_id, chat in chats.items() }
 
-        sess.query(ChatUser).filter(
-            ChatUser.chat_id.in_(chat_ids),
-            ChatUser.user_id != data.user_id
-        ).update({
-            ChatUser.unread_count: ChatUser.unread_count + 1
-        })
+    # Prepare data, images are written before the transaction, so it holds the write lock only for inserts
 
-        date_time = get_now_datetime()
-        message_ids = {}
+    date_time = get_now_datetime()
+    message_ids = {}
+    message_rows = []
+    last_messages = []
+    images = []
 
+    try:
         for msg in data.messages:
-            # Add to database
-
             id_ = get_UUID()
             message_ids[msg.chat_id] = id_
 
             if msg.image:
+                images.append(f'{id_}_msg_image')
+
                 if not await save_image(f'{id_}_msg_image', msg.image):
                     raise HTTPException(400, 'Image error')
 
-            sess.add(Message(
-                id=id_,
-                chat_id=msg.chat_id,
-                content=msg.content,
-                with_image=bool(msg.image),
-                date_time=date_time,
-                reply_content=msg.reply_content,
-                reply_sender_id=data.reply_sender_id,
-                sender_id=data.user_id,
-            ))
-
-            # Notify clients
-
-            notifi = resp.NewMessage(
-                chat_id=msg.chat_id,
-                message=resp.Message(
-                    id=id_,
-                    sender_id=data.user_id,
-                    content=msg.content,
-                    image=msg.image,
-                    date_time=date_time,
-                    reply_content=msg.reply_content,
-                    reply_sender_id=data.reply_sender_id,
-            )).model_dump_json()
-
-            query = select(ChatUser.user_id).where(ChatUser.chat_id == msg.chat_id, ChatUser.user_id != data.user_id)
-            user_ids = sess.execute(query).scalars().all()
-
-            for user_id in user_ids:
-                if user_id in connected_clients:
-                    await connected_clients[user_id].send_text(notifi)
-
-        sess.query(Chat).filter(Chat.id.in_(chat_ids)).update({
-            Chat.unread_senders: Chat.unread_senders + f'{data.user_id};'
-        })
+            message_rows.append({
+                'id':              id_,
+                'chat_id':         msg.chat_id,
+                'content':         msg.content,
+                'with_image':      bool(msg.image),
+                'date_time':       date_time,
+                'reply_content':   msg.reply_content,
+                'reply_sender_id': data.reply_sender_id,
+                'sender_id':       data.user_id,
+            })
+            last_messages.append({
+                'id':                     msg.chat_id,
+                'last_message_id':        id_,
+                'last_message_content':   msg.content,
+                'last_message_datetime':  date_time,
+                'last_message_sender_id': data.user_id,
+            })
+
+        # Add to database
+
+        async with AsyncSessionMaker.begin() as sess:
+            await sess.execute(insert(Message), message_rows)
+            # bulk update by primary key
+            await sess.execute(sql_update(Chat), last_messages)
+
+            await sess.execute(sql_update(ChatUser).where(
+                ChatUser.chat_id.in_(chat_ids),
+                ChatUser.user_id != data.user_id
+            ).values({
+                ChatUser.unread_count: ChatUser.unread_count + 1
+            }))
+
+            # set of senders, whom /chat/read notifies, so row exists only once per sender
+            await sess.execute(
+                sqlite_insert(ChatUnreadSender).on_conflict_do_nothing(),
+                [{ 'chat_id': chat_id, 'user_id': data.user_id } for chat_id in set(chat_ids)]
+            )
+
+            # Notifications are committed with messages and sent by outbox dispatcher
+
+            for msg in data.messages:
+                notifi = resp.NewMessage(
+                    chat_id=msg.chat_id,
+                    message=resp.Message(
+                        id=message_ids[msg.chat_id],
+                        sender_id=data.user_id,
+                        content=msg.content,
+                        image=msg.image,
+                        date_time=date_time,
+                        reply_content=msg.reply_content,
+                        reply_sender_id=data.reply_sender_id,
+                )).model_dump_json()
+
+                add_event(sess, recipients[msg.chat_id], notifi)
+    except:
+        for filename in images:
+            remove_image(filename)
+        raise
+
+    outbox.notify()
 
     return resp.SentMessage(message_ids=message_ids, date_time=date_time)
 
 
 @router.post('/message/like', tags=['Message'])
 async def like(data: reque.Like):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
 
-    with SessionMaker.begin() as sess:
-        row = sess.query(
-            ChatUser.chat_id,
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(
+            Message.chat_id,
             Like.user_id,
-        ).select_from(Message).filter(
+        ).where(
             Message.id == data.message_id
         ).outerjoin(
-            ChatUser, and_(
-            ChatUser.chat_id == Message.chat_id,
-            ChatUser.user_id == data.user_id
-        )).outerjoin(
             Like, and_(
             Like.message_id == Message.id,
             Like.user_id == data.user_id
-        )).first()
+        ))
+        row = (await sess.execute(query)).first()
 
         if row is None:
             raise HTTPException(404, 'Message with this ID not exists')
 
         chat_id, like_user_id = row.tuple()
+        chat = await get_chat(sess, chat_id)
 
-        if chat_id is None:
+        if chat is None or chat.is_admin(data.user_id) is None:
             raise HTTPException(403, 'You are not a member of this chat')
 
 
         is_liked = not like_user_id is None
 
         if is_liked:
-            sess.query(Like).filter(
+            await sess.execute(sql_delete(Like).where(
                 Like.message_id == data.message_id,
                 Like.user_id == data.user_id
-            ).delete()
+            ))
         else:
             sess.add(Like(message_id=data.message_id, user_id=data.user_id))
 
-        query = select(ChatUser.user_id).where(ChatUser.chat_id == chat_id, ChatUser.user_id != data.user_id)
-        user_ids = sess.execute(query).scalars().all()
+        await sess.execute(sql_update(Message).where(Message.id == data.message_id).values({
+            Message.likes_count: Message.likes_count + (-1 if is_liked else 1)
+        }))
 
+        notifi = resp.NewLike(
+            chat_id=chat_id,
+            message_id=data.message_id,
+            is_liked=not is_liked
+        ).model_dump_json()
 
-    notifi = resp.NewLike(
-        chat_id=chat_id,
-        message_id=data.message_id,
-        is_liked=not is_liked
-    ).model_dump_json()
+        add_event(sess, chat.others(data.user_id), notifi)
 
-    for user_id in user_ids:
-        if user_id in connected_clients:
-            await connected_clients[user_id].send_text(notifi)
+    outbox.notify()
 
 
 @router.delete('/message/delete', tags=['Message'])
 async def delete(data: reque.DeleteMessages):
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
     
     if not data.message_ids:
         raise HTTPException(400, 'Messages are not specified')
     
-    with SessionMaker.begin() as sess:
-        rows = sess.query(
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(
             Message.id,
             Message.sender_id,
             Message.with_image
-        ).filter(
+        ).where(
             Message.id.in_(data.message_ids),
             Message.chat_id == data.chat_id
-        ).all()
+        )
+        rows = (await sess.execute(query)).all()
 
         if len(rows) < len(data.message_ids):
             raise HTTPException(404, 'Message with this ID not exists')
         
 
-        chat_type, is_admin = sess.query(
-            Chat.type,
-            ChatUser.is_admin
-        ).filter(
-            Chat.id == data.chat_id
-        ).outerjoin(
-            ChatUser, and_(
-            ChatUser.chat_id == data.chat_id,
-            ChatUser.user_id == data.user_id
-        )).first().tuple()
+        chat = await get_chat(sess, data.chat_id)
+        is_admin = chat.is_admin(data.user_id)
 
         if is_admin is None:
             raise HTTPException(403, 'You are not a member of this chat')
@@ -211,27 +232,72 @@ async def delete(data: reque.DeleteMessages):
         for row in rows:
             id_, sender_id, with_image = row.tuple()
 
-            if not is_admin and not (chat_type == ChatTypes.group.name and sender_id == data.user_id):
+            if not is_admin and not (chat.type == ChatTypes.group.name and sender_id == data.user_id):
                 raise HTTPException(403, "You can't delete message(s)")
             
             if with_image:
                 messages_with_image.append(id_)
 
 
-        sess.query(Message).filter(Message.id.in_(data.message_ids)).delete()
+        await sess.execute(sql_delete(Message).where(Message.id.in_(data.message_ids)))
 
+        query = select(Chat.last_message_id).where(Chat.id == data.chat_id)
+        last_message_id: str | None = (await sess.execute(query)).scalar()
+
+        if last_message_id in data.message_ids:
+            query = select(
+                Message.id,
+                Message.content,
+                Message.date_time,
+                Message.sender_id
+            ).where(
+                Message.chat_id == data.chat_id
+            ).order_by(Message.date_time.desc(), Message.id.desc()).limit(1)
+            row = (await sess.execute(query)).first()
+
+            id_, content, date_time, sender_id = (None,) * 4 if row is None else row.tuple()
+
+            await sess.execute(sql_update(Chat).where(Chat.id == data.chat_id).values({
+                Chat.last_message_id:        id_,
+                Chat.last_message_content:   content,
+                Chat.last_message_datetime:  date_time,
+                Chat.last_message_sender_id: sender_id,
+            }))
+
+
+        notifi = resp.DeletedMessages(
+            chat_id=data.chat_id,
+            message_ids=data.message_ids
+        ).model_dump_json()
+
+        add_event(sess, chat.others(data.user_id), notifi)
+
+    outbox.notify()
 
-        query = select(ChatUser.user_id).where(ChatUser.chat_id == data.chat_id, ChatUser.user_id != data.user_id)
-        user_ids = sess.execute(query).scalars().all()
-    
     for id_ in messages_with_image:
         remove_image(f'{id_}_msg_image')
 
-    notifi = resp.DeletedMessages(
-        chat_id=data.chat_id,
-        message_ids=data.message_ids
-    ).model_dump_json()
 
-    for user_id in user_ids:
-        if user_id in connected_clients:
-            await connected_clients[user_id].send_text(notifi)
+@router.get('/message/image/{message_id}', tags=['Message'], response_class=Response)
+def image(message_id: str, request: Request):
+    if not UUID_RE.fullmatch(message_id):
+        raise HTTPException(404, 'Image not found')
+
+    filename = f'{message_id}_msg_image'
+    etag = image_etag(filename)
+
+    if etag is None:
+        raise HTTPException(404, 'Image not found')
+
+    # image of message never changes, so client can keep it while ETag is the same
+    headers = { 'ETag': etag, 'Cache-Control': 'private, max-age=31536000, immutable' }
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        content = read_image(filename)
+    except FileNotFoundError:
+        raise HTTPException(404, 'Image not found')
+
+    return Response(content, media_type='text/plain', headers=headers)
@@ -1,48 +1,65 @@
 from typing import Literal
 import json
-from fastapi import APIRouter, HTTPException, Form, UploadFile
+from fastapi import APIRouter, HTTPException, Form, UploadFile, Request, Response
 import models.requests as reque
 import models.responses as resp
-from sqlalchemy import or_, and_, select, case
-from database.database import SessionMaker
+from sqlalchemy import or_, and_, select, update, delete, case
+from sqlalchemy.exc import IntegrityError
+from database.database import SessionMaker, AsyncSessionMaker
 from database.models import User, ChatUser, Chat
-from tools import connected_clients, auth_user, check_auth, logout_user, hash_password, check_password, parse_model, get_now_datetime, get_UUID, save_image, remove_image
+from database.search import search_users
+from database.membership import invalidate_chats_async
+from database.profiles import get_profiles, invalidate_profiles, invalidate_profiles_async
+from realtime.broker import broker
+from realtime.outbox import outbox, add_event
+from security.tokens import auth_user_async, revoke_user_async, check_auth, check_auth_async, logout_user
+from security.passwords import password_hasher, hash_password, check_password
+from tools import parse_model, fast_response, make_etag, etag_matches, get_now_datetime, get_UUID, save_image, remove_image
 
 
 router = APIRouter()
 
 
 @router.post('/user/register', tags=['User'], response_model=resp.Register)
-def register(data: reque.Register):
-    with SessionMaker.begin() as sess:
-        user_id: str | None = sess.query(User.id).filter(or_(
+async def register(data: reque.Register):
+    async with AsyncSessionMaker() as sess:
+        query = select(User.id).where(or_(
             User.email == data.email,
             User.nickname == data.nickname
-        )).scalar()
-
-        if not user_id is None:
-            raise HTTPException(400, 'User with that email or nicname is already exists')
-        
-        id_ = get_UUID()
-
-        sess.add(User(
-            id=id_,
-            email=data.email,
-            password=hash_password(data.password),
-            name=data.name,
-            nickname=data.nickname,
-            with_avatar=False,
-            pub_key=data.pub_key,
-            priv_key=data.priv_key,
         ))
+        user_id: str | None = (await sess.execute(query)).scalar()
+
+    if not user_id is None:
+        raise HTTPException(400, 'User with that email or nicname is already exists')
 
-    return resp.Register(user_id=id_, token=auth_user(id_))
+    # hash without an open transaction, it takes a while
+    password = await hash_password(data.password)
+
+    id_ = get_UUID()
+
+    try:
+        async with AsyncSessionMaker.begin() as sess:
+            sess.add(User(
+                id=id_,
+                email=data.email,
+                password=password,
+                name=data.name,
+                nickname=data.nickname,
+                with_avatar=False,
+                pub_key=data.pub_key,
+                priv_key=data.priv_key,
+            ))
+    except IntegrityError:
+        # another registration with the same email or nickname was committed while hashing
+        raise HTTPException(400, 'User with that email or nicname is already exists')
+
+    return resp.Register(user_id=id_, token=await auth_user_async(id_))
 
 
 @router.post('/user/login', tags=['User'], response_model=resp.Login)
-def login(data: reque.Login):
-    with SessionMaker() as sess:
-        row = sess.query(
+async def login(data: reque.Login):
+    async with AsyncSessionMaker() as sess:
+        query = select(
             User.id,
             User.password,
             User.priv_key,
@@ -50,19 +67,27 @@ def login(data: reque.Login):
             User.nickname,
             User.with_avatar,
             User.latest_key_update
-        ).filter(User.email == data.email).first()
+        ).where(User.email == data.email)
+        row = (await sess.execute(query)).first()
 
     if row is None:
         raise HTTPException(404, 'User with this email not found')
     
     user_id, password, priv_key, name, nickname, with_avatar, latest_key_update = row.tuple()
     
-    if not check_password(data.password, password):
+    if not await check_password(data.password, password):
         raise HTTPException(401, 'Wrong password')
 
+    # bcrypt cost was changed, password is known only now, so hash it again
+    if password_hasher.needs_rehash(password):
+        password = await hash_password(data.password)
+
+        async with AsyncSessionMaker.begin() as sess:
+            await sess.execute(update(User).where(User.id == user_id).values({ User.password: password }))
+
     return resp.Login(
         user_id=user_id,
-        token=auth_user(user_id),
+        token=await auth_user_async(user_id),
         priv_key=priv_key,
         name=name,
         nickname=nickname,
@@ -76,21 +101,30 @@ def logout(data: reque.Auth):
     if not check_auth(data):
         raise HTTPException(401, 'Wrong token')
 
-    logout_user(data.user_id)
+    logout_user(data.user_id, data.token)
+
 
+# clients repeat the same lookups, so they get ETag and an unchanged response costs 304,
+# profiles come from the cache, so it also costs no database work
 
 @router.post('/user/pub_keys', tags=['User'], response_model=dict[str, str])
-def pub_keys(data: reque.Users):
+def pub_keys(data: reque.Users, request: Request):
     with SessionMaker() as sess:
-        rows = sess.query(User.id, User.pub_key).filter(User.id.in_(data.user_ids)).all()
+        profiles = get_profiles(sess, data.user_ids)
+
+    # key is changed only together with latest_key_update
+    etag = make_etag(*(f'{id_}:{profile.latest_key_update.isoformat()}' for id_, profile in sorted(profiles.items())))
+    headers = { 'ETag': etag, 'Cache-Control': 'private, no-cache' }
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
 
     keys = {}
 
-    for row in rows:
-        user_id, pub_key = row.tuple()
-        keys[user_id] = pub_key
+    for user_id, profile in profiles.items():
+        keys[user_id] = profile.pub_key
 
-    return keys
+    return fast_response(keys, headers)
 
 
 @router.put('/user/update_keys_data', tags=['User'])
@@ -114,31 +148,40 @@ def update_keys_data(data: reque.UpdateKeysData):
             ),
         })
 
+    invalidate_profiles([data.user_id])
+
 
 @router.post('/user/users', tags=['User'], response_model=dict[str, resp.User])
-def users(data: reque.Users):
+def users(data: reque.Users, request: Request):
     with SessionMaker() as sess:
-        rows = sess.query(
-            User.id,
-            User.name,
-            User.nickname,
-            User.with_avatar,
-            User.last_visit
-        ).filter(User.id.in_(data.user_ids)).all()
-    
+        profiles = get_profiles(sess, data.user_ids)
+
+    online_ids = broker.online_users(profiles)
+
+    # profile version is changed with name, nickname and avatar, the rest is in the tag as is
+    etag = make_etag(*(
+        f'{id_}:{profile.profile_version}:{profile.last_visit.isoformat()}:{id_ in online_ids}'
+        for id_, profile in sorted(profiles.items())
+    ))
+    headers = { 'ETag': etag, 'Cache-Control': 'private, no-cache' }
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
     users = {}
 
-    for row in rows:
-        id_, name, nickname, with_avatar, last_visit = row.tuple()
-        users[id_] = resp.User(
-            name=name,
-            nickname=nickname,
-            with_avatar=with_avatar,
-            last_visit=last_visit,
-            is_online=id_ in connected_clients
-        )
+    # profiles are written straight to JSON, fields are the same as in resp.User
+    for id_, profile in profiles.items():
+        users[id_] = {
+            'id':          None,
+            'name':        profile.name,
+            'nickname':    profile.nickname,
+            'with_avatar': profile.with_avatar,
+            'last_visit':  profile.last_visit,
+            'is_online':   id_ in online_ids,
+        }
     
-    return users
+    return fast_response(users, headers)
 
 
 @router.put('/user/update_data', tags=['User'])
@@ -147,24 +190,26 @@ async def update_data(data: str = Form(...), avatar: UploadFile | Literal['none'
     if not data:
         raise HTTPException(400, 'Wrong parameters')
 
-    if not check_auth(data):
+    if not await check_auth_async(data):
         raise HTTPException(401, 'Wrong token')
 
-    with SessionMaker.begin() as sess:
-        user_id: str | None = sess.query(User.id).filter(
+    async with AsyncSessionMaker.begin() as sess:
+        query = select(User.id).where(
             User.id != data.user_id, or_(
             User.email == data.email,
             User.nickname == data.nickname
-        )).scalar()
+        ))
+        user_id: str | None = (await sess.execute(query)).scalar()
 
         if not user_id is None:
             raise HTTPException(400, 'User with that email or nicname is already exists')
 
 
         values = {
-            User.email:    data.email,
-            User.name:     data.name,
-            User.nickname: data.nickname,
+            User.email:           data.email,
+            User.name:            data.name,
+            User.nickname:        data.nickname,
+            User.profile_version: User.profile_version + 1,
         }
 
         if avatar != 'null':
@@ -177,53 +222,69 @@ async def update_data(data: str = Form(...), avatar: UploadFile | Literal['none'
                 values[User.with_avatar] = True
 
                 
-        sess.query(User).filter(User.id == data.user_id).update(values)
+        await sess.execute(update(User).where(User.id == data.user_id).values(values))
+
+    await invalidate_profiles_async([data.user_id])
 
 
 @router.put('/user/update_password', tags=['User'])
-def update_password(data: reque.UpdatePassword):
-    with SessionMaker.begin() as sess:
-        password: str | None = sess.query(User.password).filter(User.id == data.user_id).scalar()
+async def update_password(data: reque.UpdatePassword):
+    async with AsyncSessionMaker() as sess:
+        query = select(User.password).where(User.id == data.user_id)
+        password: str | None = (await sess.execute(query)).scalar()
 
-        if password is None:
-            raise HTTPException(404, 'User with this ID not found')
-        
-        if not check_password(data.curr_password, password):
-            raise HTTPException(401, 'Wrong password')
+    if password is None:
+        raise HTTPException(404, 'User with this ID not found')
+    
+    if not await check_password(data.curr_password, password):
+        raise HTTPException(401, 'Wrong password')
 
-        sess.query(User).filter(User.id == data.user_id).update({
-            User.password: hash_password(data.new_password),
+    new_password = await hash_password(data.new_password)
+
+    async with AsyncSessionMaker.begin() as sess:
+        result = await sess.execute(update(User).where(User.id == data.user_id, User.password == password).values({
+            User.password: new_password,
             User.priv_key: data.priv_key
-        })
+        }))
+
+    # password was changed (or the user deleted) by another request while hashing
+    if result.rowcount == 0:
+        raise HTTPException(409, 'Password was changed by another request')
 
 
 @router.delete('/user/delete', tags=['User'])
 async def delete_user(data: reque.DeleteUser):
-    with SessionMaker.begin() as sess:
-        password: str | None = sess.query(User.password).filter(User.id == data.user_id).scalar()
+    async with AsyncSessionMaker() as sess:
+        query = select(User.password).where(User.id == data.user_id)
+        password: str | None = (await sess.execute(query)).scalar()
 
-        if password is None:
-            raise HTTPException(404, 'User with this ID not found')
+    if password is None:
+        raise HTTPException(404, 'User with this ID not found')
 
-        if not check_password(data.password, password):
-            raise HTTPException(401, 'Wrong password')
+    if not await check_password(data.password, password):
+        raise HTTPException(401, 'Wrong password')
 
+    async with AsyncSessionMaker.begin() as sess:
         query = select(ChatUser.chat_id).where(ChatUser.user_id == data.user_id)
-        chat_ids: list[str] = sess.execute(query).scalars().all()
+        chat_ids: list[str] = (await sess.execute(query)).scalars().all()
 
         if chat_ids:
-            sess.query(Chat).filter(Chat.id.in_(chat_ids)).update({
+            await sess.execute(update(Chat).where(Chat.id.in_(chat_ids)).values({
                 Chat.members_count: Chat.members_count - 1
-            })
+            }))
 
-        sess.query(User).filter(User.id == data.user_id).delete()
+        await sess.execute(delete(User).where(User.id == data.user_id))
 
-    remove_image(f'{data.user_id}_avatar')
+        notifi = resp.DeletedUser(user_id=data.user_id).model_dump_json()
+        add_event(sess, None, notifi)
 
-    notifi = resp.DeletedUser(user_id=data.user_id).model_dump_json()
+    await invalidate_chats_async(chat_ids)
+    await invalidate_profiles_async([data.user_id])
+    outbox.notify()
 
-    for socket in connected_clients.values():
-        await socket.send_text(notifi)
+    # tokens are deleted by cascade, but they can be still cached
+    await revoke_user_async(data.user_id)
+    remove_image(f'{data.user_id}_avatar')
 
 
 @router.post('/user/search', tags=['User'], response_model=list[resp.User])
@@ -239,7 +300,6 @@ def search(data: reque.SearchUsers):
             User.with_avatar,
             User.last_visit,
         ).filter(
-            User.nickname.icontains(data.value),
             User.id != data.user_id
         )
 
@@ -258,19 +318,22 @@ def search(data: reque.SearchUsers):
                 ChatUser.user_id == User.id
             )).filter(ChatUser.chat_id == None)
 
-        rows = query.limit(20).all()
+        query = search_users(query, data.value)
+        rows = query.limit(data.limit).offset(data.offset).all()
         users = []
+        online_ids = broker.online_users(row.id for row in rows)
 
+        # rows are written straight to JSON, fields are the same as in resp.User
         for row in rows:
             id_, name, nickname, with_avatar, last_visit = row.tuple()
 
-            users.append(resp.User(
-                id=id_,
-                name=name,
-                nickname=nickname,
-                with_avatar=with_avatar,
-                last_visit=last_visit,
-                is_online=id_ in connected_clients
-            ))
+            users.append({
+                'id':          id_,
+                'name':        name,
+                'nickname':    nickname,
+                'with_avatar': with_avatar,
+                'last_visit':  last_visit,
+                'is_online':   id_ in online_ids,
+            })
         
-        return users
+        return fast_response(users)
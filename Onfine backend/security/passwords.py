@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+from fastapi import HTTPException
+from config import BCRYPT_ROUNDS, PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT
+
+
+# bcrypt takes tens of milliseconds of CPU, so it runs in separate processes
+# and doesn't hold GIL of threadpool which serves all sync routes
+
+def bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+def bcrypt_check(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int, workers: int, queue_limit: int):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pool: ProcessPoolExecutor | None = None
+        # jobs which are waiting or running in the pool
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    def start(self):
+        if self.pool is None:
+            # 'spawn', because forking the server process with its threads isn't safe
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def hash(self, password: str) -> str:
+        return await self.__run(bcrypt_hash, password, self.rounds)
+
+    async def check(self, password: str, hashed_password: str) -> bool:
+        return await self.__run(bcrypt_check, password, hashed_password)
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        # hash looks like $2b$12$..., where 12 is the cost it was made with
+        try:
+            return int(hashed_password.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self) -> dict:
+        return {
+            'workers':     self.workers,
+            'pending':     self.pending,
+            'queue_limit': self.queue_limit,
+            'rejected':    self.rejected,
+            'restarts':    self.restarts,
+        }
+
+    async def __run(self, func, *args):
+        # shed load instead of queueing requests which would time out anyway
+        if self.pending >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(503, 'Server is busy, try again later', headers={ 'Retry-After': '1' })
+
+        self.pending += 1
+
+        try:
+            # a worker which was killed (e.g. by OOM killer) breaks the whole pool,
+            # so it's replaced by a new one and the job is tried once more
+            for _ in range(2):
+                self.start()
+                pool = self.pool
+
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+                except BrokenProcessPool:
+                    self.__restart(pool)
+
+            raise HTTPException(503, 'Server is busy, try again later', headers={ 'Retry-After': '1' })
+        finally:
+            self.pending -= 1
+
+    def __restart(self, pool: ProcessPoolExecutor):
+        # other jobs of the same pool fail too, it's replaced only once
+        if self.pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            self.restarts += 1
+
+
+password_hasher = PasswordHasher(BCRYPT_ROUNDS, PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
+
+async def check_password(password: str, hashed_password: str) -> bool:
+    return await password_hasher.check(password, hashed_password)
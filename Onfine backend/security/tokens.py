@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from secrets import token_hex
+from sqlalchemy import select, delete
+from config import AUTH_TOKEN_TTL, AUTH_CACHE_TTL, AUTH_CACHE_SIZE
+from database.database import SessionMaker
+from database.models import AuthToken
+from models.requests import Auth as AuthRequest
+from tools import get_now_datetime
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+    '''LRU cache of valid tokens (token hash -> user id and expiry) of this worker.'''
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items: OrderedDict[str, tuple[str, datetime, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[str, datetime] | None:
+        with self.lock:
+            item = self.items.get(key)
+
+            if item is None:
+                return None
+
+            user_id, expires_at, cached_until = item
+
+            if cached_until < time.monotonic():
+                del self.items[key]
+                return None
+
+            self.items.move_to_end(key)
+            return user_id, expires_at
+
+    def put(self, key: str, user_id: str, expires_at: datetime):
+        with self.lock:
+            self.items[key] = (user_id, expires_at, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def invalidate_user(self, user_id: str):
+        with self.lock:
+            keys = [key for key, item in self.items.items() if item[0] == user_id]
+
+            for key in keys:
+                del self.items[key]
+
+
+class TokenStore(ABC):
+    @abstractmethod
+    def create(self, user_id: str) -> str: ...
+
+    @abstractmethod
+    def check(self, user_id: str, token: str) -> bool: ...
+
+    async def check_async(self, user_id: str, token: str) -> bool:
+        return await asyncio.to_thread(self.check, user_id, token)
+
+    @abstractmethod
+    def revoke(self, user_id: str, token: str): ...
+
+    @abstractmethod
+    def revoke_user(self, user_id: str): ...
+
+
+class DatabaseTokenStore(TokenStore):
+    '''
+    Tokens are kept in `auth_tokens` table, which is shared by all workers, so every worker
+    accepts a token given by another one. A user can have several tokens (one per session).
+    '''
+
+    def __init__(self, cache: TokenCache, token_ttl: float):
+        self.cache = cache
+        self.token_ttl = timedelta(seconds=token_ttl)
+
+    def create(self, user_id: str) -> str:
+        token = token_hex(16)
+        key = hash_token(token)
+        now = get_now_datetime()
+        expires_at = now + self.token_ttl
+
+        with SessionMaker.begin() as sess:
+            # expired sessions of the user are not needed anymore
+            sess.execute(delete(AuthToken).where(AuthToken.user_id == user_id, AuthToken.expires_at <= now))
+            sess.add(AuthToken(token_hash=key, user_id=user_id, created_at=now, expires_at=expires_at))
+
+        self.cache.put(key, user_id, expires_at)
+        return token
+
+    def check(self, user_id: str, token: str) -> bool:
+        key = hash_token(token)
+        item = self.cache.get(key) or self.load(key)
+        return self.is_valid(item, user_id)
+
+    async def check_async(self, user_id: str, token: str) -> bool:
+        # only a cache miss reads the database, so only it is run in a thread
+        key = hash_token(token)
+        item = self.cache.get(key) or await asyncio.to_thread(self.load, key)
+        return self.is_valid(item, user_id)
+
+    def load(self, key: str) -> tuple[str, datetime] | None:
+        with SessionMaker() as sess:
+            query = select(AuthToken.user_id, AuthToken.expires_at).where(AuthToken.token_hash == key)
+            row = sess.execute(query).first()
+
+        if row is None:
+            return None
+
+        item = row.tuple()
+        self.cache.put(key, *item)
+        return item
+
+    def is_valid(self, item: tuple[str, datetime] | None, user_id: str) -> bool:
+        if item is None:
+            return False
+
+        token_user_id, expires_at = item
+        return token_user_id == user_id and expires_at > get_now_datetime()
+
+    def revoke(self, user_id: str, token: str):
+        key = hash_token(token)
+
+        with SessionMaker.begin() as sess:
+            sess.execute(delete(AuthToken).where(AuthToken.token_hash == key, AuthToken.user_id == user_id))
+
+        self.cache.invalidate(key)
+
+    def revoke_user(self, user_id: str):
+        with SessionMaker.begin() as sess:
+            sess.execute(delete(AuthToken).where(AuthToken.user_id == user_id))
+
+        self.cache.invalidate_user(user_id)
+
+
+token_store = DatabaseTokenStore(TokenCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL), AUTH_TOKEN_TTL)
+
+
+def auth_user(user_id: str) -> str:
+    return token_store.create(user_id)
+
+def check_auth(data: AuthRequest) -> bool:
+    return token_store.check(data.user_id, data.token)
+
+def logout_user(user_id: str, token: str):
+    token_store.revoke(user_id, token)
+
+
+# store reads and writes the database by sync session, so async routes run it in a thread,
+# otherwise the event loop is blocked while an async transaction holds the write lock
+
+async def check_auth_async(data: AuthRequest) -> bool:
+    return await token_store.check_async(data.user_id, data.token)
+
+async def auth_user_async(user_id: str) -> str:
+    return await asyncio.to_thread(auth_user, user_id)
+
+async def logout_user_async(user_id: str, token: str):
+    await asyncio.to_thread(logout_user, user_id, token)
+
+async def revoke_user_async(user_id: str):
+    await asyncio.to_thread(token_store.revoke_user, user_id)
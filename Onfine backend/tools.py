@@ -1,25 +1,156 @@
 import uuid
 import os
+import json
+import hashlib
+import base64
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Iterable
 from secrets import token_hex
-import bcrypt
 from pydantic import BaseModel, ValidationError
-from fastapi import WebSocket, UploadFile
-from models.requests import Auth as AuthRequest
+from fastapi import WebSocket, UploadFile, HTTPException, Request, Response
+from config import MAX_IMAGE_SIZE, IMAGE_CHUNK_SIZE, IMAGE_CACHE_SIZE
 from datetime import datetime, UTC
 
+try:
+    import orjson
+except ImportError:
+    orjson = None # fast JSON encoder is optional
+
 
 IMAGES_PATH = './images'
 os.makedirs(IMAGES_PATH, exist_ok=True)
 
-async def save_image(filename: str, file: UploadFile | str) -> bool:
+
+class LRUCache:
+    '''
+    LRU cache of this worker, bounded by the total size of cached values (1 per value, unless
+    `sizeof` is overridden). Values are put with the version which was read before loading them,
+    and every invalidation increments it, so a value loaded concurrently with an invalidation is not cached.
+    '''
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def sizeof(self, value) -> int:
+        return 1
+
+    def get(self, key: str):
+        with self.lock:
+            value = self.items.get(key)
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(key)
+
+            return value
+
+    def put(self, key: str, value, version: int):
+        size = self.sizeof(value)
+
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if version != self.version:
+                return
+
+            old = self.items.pop(key, None)
+
+            if old is not None:
+                self.size -= self.sizeof(old)
+
+            self.items[key] = value
+            self.size += size
+
+            while self.size > self.max_size:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+                self.evictions += 1
+
+    def invalidate(self, keys: Iterable[str]):
+        with self.lock:
+            self.version += 1
+
+            for key in keys:
+                value = self.items.pop(key, None)
+
+                if value is not None:
+                    self.size -= self.sizeof(value)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'items':     len(self.items),
+                'size':      self.size,
+                'max_size':  self.max_size,
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class ImageCache(LRUCache):
+    '''LRU cache of image contents, bounded by the total size of cached images.'''
+
+    def sizeof(self, value: str) -> int:
+        return len(value)
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE)
+
+class ImageTooLargeError(Exception): pass
+
+def __write_image(path: str, source: BinaryIO | bytes):
+    # write to temp file and rename it, so readers never see a partly written image
+    temp_path = f'{path}.{token_hex(4)}.tmp'
+
     try:
-        path = os.path.join(IMAGES_PATH, filename)
-        mode = 'w' if isinstance(file, str) else 'wb'
+        with open(temp_path, 'wb') as f:
+            if isinstance(source, bytes):
+                if len(source) > MAX_IMAGE_SIZE:
+                    raise ImageTooLargeError()
+
+                f.write(source)
+            else:
+                size = 0
+
+                while chunk := source.read(IMAGE_CHUNK_SIZE):
+                    size += len(chunk)
 
-        with open(path, mode) as f:
-            f.write(file if isinstance(file, str) else await file.read())
+                    if size > MAX_IMAGE_SIZE:
+                        raise ImageTooLargeError()
+
+                    f.write(chunk)
+
+        os.replace(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+async def save_image(filename: str, file: UploadFile | str) -> bool:
+    path = os.path.join(IMAGES_PATH, filename)
+    source = file.encode() if isinstance(file, str) else file.file
+
+    try:
+        await asyncio.to_thread(__write_image, path, source)
+    except ImageTooLargeError:
+        raise HTTPException(413, 'Image is too large')
     except:
         return False
+    finally:
+        image_cache.invalidate([filename])
 
     return True
 
@@ -29,38 +160,55 @@ def remove_image(filename: str):
     if os.path.exists(path):
         os.remove(path)
 
+    image_cache.invalidate([filename])
+
 def read_image(filename: str) -> str:
+    content = image_cache.get(filename)
+
+    if content is not None:
+        return content
+
+    version = image_cache.version
     path = os.path.join(IMAGES_PATH, filename)
 
     with open(path, 'r') as f:
-        return f.read()
+        content = f.read()
 
-def get_UUID(): return uuid.uuid4().hex
+    image_cache.put(filename, content, version)
+    return content
 
-def get_now_datetime(): return datetime.now(UTC).replace(tzinfo=None)
+def image_etag(filename: str) -> str | None:
+    try:
+        stat = os.stat(os.path.join(IMAGES_PATH, filename))
+    except FileNotFoundError:
+        return None
 
+    return '"' + hashlib.md5(f'{filename}-{stat.st_mtime_ns}-{stat.st_size}'.encode()).hexdigest() + '"'
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+def make_etag(*parts) -> str:
+    return '"' + hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest() + '"'
 
-def check_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = [tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')]
+    return etag in if_none_match or '*' in if_none_match
 
+def image_url(message_id: str) -> str:
+    return f'/message/image/{message_id}'
 
-connected_clients: dict[str, WebSocket] = {}
+def get_UUID(): return uuid.uuid4().hex
 
-__auth_tokens: dict[str, str] = {}
+def get_now_datetime(): return datetime.now(UTC).replace(tzinfo=None)
 
-def auth_user(user_id: str) -> str:
-    token = token_hex(16)
-    __auth_tokens[user_id] = token
-    return token
 
-def check_auth(data: AuthRequest) -> bool:
-    return __auth_tokens.get(data.user_id, None) == data.token
+def encode_cursor(date_time: datetime, id_: str) -> str:
+    return base64.urlsafe_b64encode(f'{date_time.isoformat()}|{id_}'.encode()).decode()
 
-def logout_user(user_id: str):
-    __auth_tokens.pop(user_id)
+def decode_cursor(cursor: str) -> tuple[datetime, str] | None:
+    try:
+        date_time, id_ = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(date_time), id_
+    except ValueError:
+        return None
 
 
 def parse_model(model: BaseModel, **fields) -> BaseModel | None:
@@ -71,3 +219,30 @@ def parse_model(model: BaseModel, **fields) -> BaseModel | None:
 
 async def json_response(socket: WebSocket, message: str, status: int = 200) -> dict:
     await socket.send_json({ 'message': message, 'status': status })
+
+
+def __json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dump_json(content) -> bytes:
+    if orjson:
+        return orjson.dumps(content)
+
+    return json.dumps(content, default=__json_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+class FastJSONResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+def fast_response(content, headers: dict[str, str] | None = None) -> FastJSONResponse:
+    '''
+    Content (dicts in the shape of response_model of the route) is written to bytes as is.
+    Returned Response skips validation and serialization by response_model, which still describes the route in OpenAPI.
+    '''
+
+    return FastJSONResponse(content, headers=headers)